@@ -0,0 +1,204 @@
+# Copyright 2012, Julius Seporaitis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks of the plugin's hot paths.
+
+Downloads run against s3server.S3Server on localhost, which checks the
+signature of every request, so the numbers include signing, the
+connection pool and the transfer loop but no network latency.
+
+Usage: python benchmarks.py [--seconds S] [--small-files N] [--large-size MB]
+"""
+
+import glob
+import httplib
+import itertools
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append('.')
+import s3iam
+from s3server import S3Server, ACCESS_KEY, SECRET_KEY
+
+BUCKET = 'bench'
+BASEURL = 'https://%s.s3.amazonaws.com/' % BUCKET
+PACKAGE_NAME = 'yum-plugin-s3-iam'
+
+
+def route_to(server):
+    """Send every pooled S3 connection to the local server."""
+    address = server.server_address
+    s3iam.ConnectionPool._connect = \
+        lambda self, key: httplib.HTTPConnection(*address)
+
+
+def make_grabber(region=None):
+    grabber = s3iam.S3Grabber(BASEURL)
+    grabber.region = region
+    grabber.set_credentials(ACCESS_KEY, SECRET_KEY)
+    grabber.pool = s3iam.ConnectionPool(s3iam.DEFAULT_POOL_SIZE)
+    return grabber
+
+
+def rate(func, seconds):
+    """Call func() repeatedly for about `seconds`, return calls/second."""
+    count = 0
+    start = time.time()
+    deadline = start + seconds
+    while True:
+        func()
+        count += 1
+        now = time.time()
+        if now >= deadline:
+            return count / (now - start)
+
+
+def report(name, value, unit):
+    print '%-42s %12.1f %s' % (name, value, unit)
+    sys.stdout.flush()
+
+
+def bench_signing(options):
+    for name, region in (('signV2', None), ('signV4', 'us-east-1')):
+        grabber = make_grabber(region)
+        report(name, rate(lambda: grabber._request('repodata/repomd.xml'),
+                          options.seconds), 'requests/s')
+
+
+def bench_parse_url(options):
+    urls = itertools.cycle([
+        'https://foo.s3.amazonaws.com/path',
+        'https://foo.s3-us-west-2.amazonaws.com/path',
+        'https://s3.amazonaws.com/bar/path',
+        'https://s3-us-west-1.amazonaws.com/bar/path',
+        'https://s3.cn-north-1.amazonaws.com.cn/bar/path',
+    ])
+
+    def parse():
+        s3iam.ENDPOINTS.clear()
+        s3iam.parse_url(urls.next())
+
+    report('parse_url', rate(parse, options.seconds), 'urls/s')
+    report('parse_url, memoized', rate(lambda: s3iam.parse_url(urls.next()),
+                                       options.seconds), 'urls/s')
+
+
+def bench_urlgrab(options, root, dest):
+    bucket = os.path.join(root, BUCKET)
+
+    # Small metadata-like files
+    os.makedirs(os.path.join(bucket, 'repodata'))
+    for i in range(options.small_files):
+        f = open(os.path.join(bucket, 'repodata', '%d.xml' % i), 'wb')
+        f.write(os.urandom(16 * 1024))
+        f.close()
+    grabber = make_grabber()
+    latencies = []
+    start = time.time()
+    for i in range(options.small_files):
+        t = time.time()
+        grabber.urlgrab('repodata/%d.xml' % i, os.path.join(dest, '%d.xml' % i))
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    latencies.sort()
+    report('urlgrab 16K files, median latency',
+           latencies[len(latencies) / 2] * 1000, 'ms')
+    report('urlgrab 16K files', options.small_files / elapsed, 'files/s')
+
+    # One large package
+    size = options.large_size * 1024 * 1024
+    f = open(os.path.join(bucket, 'large.rpm'), 'wb')
+    for i in range(options.large_size):
+        f.write(os.urandom(1024 * 1024))
+    f.close()
+    for name, threshold in (('multipart', s3iam.DEFAULT_MULTIPART_THRESHOLD),
+                            ('single request', 0)):
+        grabber = make_grabber()
+        grabber.multipart_threshold = threshold
+        start = time.time()
+        grabber.urlgrab('large.rpm', os.path.join(dest, 'large.rpm'))
+        elapsed = time.time() - start
+        report('urlgrab %dM package, %s' % (options.large_size, name),
+               size / elapsed / 1024 / 1024, 'MB/s')
+
+
+def bench_package_lists(options, root, dest):
+    import createrepo
+    import rpm
+    import yum
+
+    rpms = glob.glob(os.path.join(rpm.expandMacro('%_rpmdir'), 'noarch',
+                                  PACKAGE_NAME + '*.rpm'))
+    if not rpms:
+        print >>sys.stderr, 'Skipping doPackageLists:', 'Rpm file required'
+        return
+    repodir = os.path.join(root, BUCKET, 'repo')
+    os.makedirs(repodir)
+    shutil.copy(rpms[0], repodir)
+    mdconf = createrepo.MetaDataConfig()
+    mdconf.directory = repodir
+    mdgen = createrepo.MetaDataGenerator(mdconf)
+    mdgen.doPkgMetadata()
+    mdgen.doRepoMetadata()
+    mdgen.doFinalMove()
+
+    yum.config.StartupConf.pluginpath = \
+        yum.config.StartupConf.pluginconfpath = yum.config.ListOption([os.getcwd()])
+    yumbase = yum.YumBase()
+    yumbase.preconf.disabled_plugins = '*'
+    yumbase.preconf.enabled_plugins = ['s3iam']
+    yumbase.preconf.debuglevel = 0
+    yumbase.conf.cachedir = os.path.join(dest, '_cache')
+    yumbase.repos.disableRepo('*')
+    yumbase.add_enable_repo('s3bench', [BASEURL + 'repo/'], s3_enabled=True,
+                            key_id=ACCESS_KEY, secret_key=SECRET_KEY)
+    start = time.time()
+    yumbase.doPackageLists()
+    report('doPackageLists', time.time() - start, 's')
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--seconds', type='float', default=2.0,
+                      help='duration of each rate measurement')
+    parser.add_option('--small-files', type='int', default=200,
+                      help='number of small files to download')
+    parser.add_option('--large-size', type='int', default=64,
+                      help='size of the large package, in MB')
+    options, args = parser.parse_args()
+
+    # Keep-alive connections aren't used through a proxy.
+    for name in ('http_proxy', 'https_proxy'):
+        os.environ.pop(name, None)
+
+    root = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    server = S3Server(root).start()
+    route_to(server)
+    try:
+        bench_signing(options)
+        bench_parse_url(options)
+        bench_urlgrab(options, root, dest)
+        bench_package_lists(options, root, dest)
+        report('requests served', server.requests, '')
+    finally:
+        server.stop()
+        shutil.rmtree(root)
+        shutil.rmtree(dest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+# Copyright 2012, Julius Seporaitis
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Load test of the plugin against s3server.S3Server.
+
+Each client stands for one host running yum: it has its own connection
+pool and temporary credentials, and for each of the repositories it
+downloads repomd.xml, the metadata files and then the packages, as yum
+does on a cold cache. All clients run at once, while the server injects
+latency, throttling, dropped connections and token expiry as asked.
+
+Usage: python loadtest.py [--clients N] [--repos N] [--packages N] ...
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+sys.path.append('.')
+import s3iam
+from benchmarks import route_to
+from s3server import S3Server, ACCESS_KEY, SECRET_KEY
+
+METADATA_FILES = ['primary.sqlite.bz2', 'filelists.sqlite.bz2',
+                  'other.sqlite.bz2', 'comps.xml.gz', 'updateinfo.xml.gz']
+
+
+def make_repositories(root, options):
+    """Create the buckets repo0 .. repoN-1, each holding a repository
+    of random data."""
+    for i in range(options.repos):
+        bucket = os.path.join(root, 'repo%d' % i)
+        os.makedirs(os.path.join(bucket, 'repodata'))
+        os.makedirs(os.path.join(bucket, 'Packages'))
+        for name in ['repomd.xml'] + METADATA_FILES:
+            write_random(os.path.join(bucket, 'repodata', name),
+                         options.metadata_size * 1024)
+        for j in range(options.packages):
+            write_random(os.path.join(bucket, 'Packages', 'pkg%d.rpm' % j),
+                         options.package_size * 1024)
+
+
+def write_random(filename, size):
+    f = open(filename, 'wb')
+    try:
+        f.write(os.urandom(size))
+    finally:
+        f.close()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Stats(object):
+    """Results of all clients."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {'metadata': [], 'package': []}
+        self.bytes = 0
+        self.errors = []
+        self.retries = {}
+
+    def add(self, kind, latency, size):
+        with self.lock:
+            self.latencies[kind].append(latency)
+            self.bytes += size
+
+    def error(self, url, e):
+        with self.lock:
+            self.errors.append('%s: %s' % (url, e))
+
+    def hook(self, event):
+        if event['event'] == 'retry':
+            with self.lock:
+                self.retries[event['reason']] = \
+                    self.retries.get(event['reason'], 0) + 1
+
+
+class Client(threading.Thread):
+    """One host fetching every repository with its own grabbers."""
+
+    def __init__(self, n, server, stats, dest, options):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.n = n
+        self.server = server
+        self.stats = stats
+        self.dest = dest
+        self.options = options
+
+    def fetch_credentials(self):
+        return {
+            'AccessKeyId': ACCESS_KEY,
+            'SecretAccessKey': SECRET_KEY,
+            'Token': self.server.token,
+            'Expiration': time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 3600)),
+        }
+
+    def make_grabber(self, repo, pool):
+        grabber = s3iam.S3Grabber('https://%s.s3.amazonaws.com/' % repo)
+        grabber.id = repo
+        grabber.region = self.options.region
+        grabber.retries = self.options.retries
+        grabber.delay = self.options.delay
+        grabber.pool = pool
+        grabber.hooks.append(self.stats.hook)
+        # A source of its own, shared by its grabbers only, as the
+        # process-wide cache would be on the host
+        grabber.credential_source = 'loadtest-%d' % self.n
+        grabber.fetch_credentials = self.fetch_credentials
+        grabber.refresh_credentials()
+        return grabber
+
+    def fetch(self, grabber, kind, path):
+        filename = os.path.join(self.dest, grabber.id, path)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        start = time.time()
+        try:
+            grabber.urlgrab(path, filename)
+        except Exception, e:
+            self.stats.error(grabber.id + '/' + path, e)
+            return
+        self.stats.add(kind, time.time() - start, os.path.getsize(filename))
+
+    def run(self):
+        pool = s3iam.ConnectionPool(s3iam.DEFAULT_POOL_SIZE)
+        for i in range(self.options.repos):
+            grabber = self.make_grabber('repo%d' % i, pool)
+            for name in ['repomd.xml'] + METADATA_FILES:
+                self.fetch(grabber, 'metadata', 'repodata/' + name)
+            for j in range(self.options.packages):
+                self.fetch(grabber, 'package', 'Packages/pkg%d.rpm' % j)
+        pool.close()
+
+
+def rotate_tokens(server, interval, stopped):
+    """Expire the server's session token every `interval` seconds."""
+    n = 0
+    while not stopped.wait(interval):
+        n += 1
+        server.expire_token('token-%d' % n)
+
+
+def report(name, value, unit):
+    print '%-42s %12.1f %s' % (name, value, unit)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--clients', type='int', default=50,
+                      help='number of hosts fetching at once')
+    parser.add_option('--repos', type='int', default=3,
+                      help='number of repositories of each host')
+    parser.add_option('--packages', type='int', default=10,
+                      help='number of packages in each repository')
+    parser.add_option('--metadata-size', type='int', default=64,
+                      help='size of each metadata file, in KB')
+    parser.add_option('--package-size', type='int', default=512,
+                      help='size of each package, in KB')
+    parser.add_option('--region', default=None,
+                      help='sign requests with SigV4 for this region '
+                           '(default SigV2)')
+    parser.add_option('--retries', type='int', default=10,
+                      help='attempts of each request')
+    parser.add_option('--delay', type='float', default=0.1,
+                      help='base delay between attempts, in seconds')
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds the server waits before each response')
+    parser.add_option('--slowdown', type='float', default=0,
+                      help='probability of a 503 SlowDown answer')
+    parser.add_option('--drop', type='float', default=0,
+                      help='probability of a connection dropped mid-body')
+    parser.add_option('--expire-every', type='float', default=0,
+                      help='expire the session token every N seconds')
+    options, args = parser.parse_args()
+
+    # Keep-alive connections aren't used through a proxy.
+    for name in ('http_proxy', 'https_proxy'):
+        os.environ.pop(name, None)
+
+    root = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    make_repositories(root, options)
+    server = S3Server(root, token='token-0', latency=options.latency,
+                      slowdown=options.slowdown, drop=options.drop).start()
+    route_to(server)
+    stats = Stats()
+    stopped = threading.Event()
+    if options.expire_every:
+        rotator = threading.Thread(target=rotate_tokens,
+                                   args=(server, options.expire_every, stopped))
+        rotator.daemon = True
+        rotator.start()
+    try:
+        clients = [Client(i, server, stats, os.path.join(dest, str(i)), options)
+                   for i in range(options.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+    finally:
+        stopped.set()
+        server.stop()
+        shutil.rmtree(root)
+        shutil.rmtree(dest)
+
+    files = sum(len(l) for l in stats.latencies.values())
+    report('elapsed', elapsed, 's')
+    report('files downloaded', files, '')
+    report('throughput', files / elapsed, 'files/s')
+    report('throughput', stats.bytes / elapsed / 1024 / 1024, 'MB/s')
+    for kind in ('metadata', 'package'):
+        for p in (50, 95, 99):
+            report('%s latency p%d' % (kind, p),
+                   percentile(stats.latencies[kind], p) * 1000, 'ms')
+    report('requests served', server.requests, '')
+    for kind, count in sorted(server.faults.items()):
+        report('faults injected: %s' % kind, count, '')
+    for reason, count in sorted(stats.retries.items()):
+        report('retries: %s' % reason, count, '')
+    report('failed downloads', len(stats.errors), '')
+    for error in stats.errors[:10]:
+        print '  ' + error
+    if stats.errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
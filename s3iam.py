@@ -13,15 +13,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import urllib2
-import urlparse
-import datetime
+import collections
+import errno
 import time
 import hashlib
-import hmac
-import json
 import os
 import re
+import stat
+import threading
 
 import yum
 import yum.config
@@ -38,20 +37,143 @@ __version__ = "1.2.2"
 
 
 __all__ = ['requires_api_version', 'plugin_type', 'CONDUIT',
-           'config_hook', 'prereposetup_hook']
+           'config_hook', 'prereposetup_hook', 'postreposetup_hook',
+           'close_hook']
+
+
+class LazyModule(object):
+    """Module imported when one of its attributes is first used.
+
+    yum loads the plugin for every command, including the many that
+    never reach S3, so modules only needed to talk to it are not
+    imported up front.
+    """
+
+    def __init__(self, name):
+        self.__name__ = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Imported once, then every lookup goes to the module itself so
+        # that changes made to it later, e.g. by tests, are seen.
+        module = self._module
+        if module is None:
+            module = self._module = __import__(self.__name__)
+        return getattr(module, attr)
+
+
+urllib2 = LazyModule('urllib2')
+urlparse = LazyModule('urlparse')
+calendar = LazyModule('calendar')
+datetime = LazyModule('datetime')
+fcntl = LazyModule('fcntl')
+hmac = LazyModule('hmac')
+httplib = LazyModule('httplib')
+json = LazyModule('json')
+Queue = LazyModule('Queue')
+random = LazyModule('random')
+shutil = LazyModule('shutil')
+socket = LazyModule('socket')
+StringIO = LazyModule('StringIO')
+tempfile = LazyModule('tempfile')
 
 requires_api_version = '2.5'
 plugin_type = yum.plugins.TYPE_CORE
 CONDUIT = None
+CREDENTIAL_CACHE = None
+CREDENTIAL_CACHE_MARGIN = 300
+PACKAGE_CACHE = None
+DEFAULT_PACKAGE_CACHE_SIZE = 1024 * 1024 * 1024
+PREFETCH = False
+# Metadata types fetched with repomd.xml, falling back to the type
+# without suffix (e.g. primary for primary_db) when not in a repository
+PREFETCH_TYPES = ['primary_db', 'filelists_db', 'group_gz', 'updateinfo']
+PREFETCH_THREADS = 8
+# Grabbers prefetch_metadata() left files with, removed by close_hook()
+# if yum never asked for them
+PREFETCHED = []
+METADATA_URL = 'http://169.254.169.254/'
+METADATA_TIMEOUT = 2
+METADATA_TOKEN_TTL = 21600
+# Seconds before IMDS is asked again for a token after the request for
+# one failed, or at all once it proved unreachable
+METADATA_RETRY_INTERVAL = 60
 DEFAULT_DELAY = 3
 DEFAULT_BACKOFF = 2
+DEFAULT_MAX_DELAY = 20
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_CONNECTIONS = 4
+DEFAULT_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+# A failed replica is avoided for REPLICA_DOWNTIME seconds, doubled with
+# each consecutive failure up to REPLICA_MAX_DOWNTIME
+REPLICA_DOWNTIME = 30
+REPLICA_MAX_DOWNTIME = 600
+# Every Nth request goes to the least recently used replica
+REPLICA_PROBE_INTERVAL = 100
+# Smallest body whose transfer rate counts as a throughput measurement
+REPLICA_MIN_SAMPLE = 64 * 1024
 BUFFER_SIZE = 1024 * 1024
+# Token buckets shared by the transfers of the process, by rate
+RATE_LIMITERS = {}
+RATE_LIMITERS_LOCK = threading.Lock()
+# Throttled transfers read at most 1/RATE_LIMIT_SLICES seconds' worth of
+# data at once, so that they take turns
+RATE_LIMIT_SLICES = 10
+RATE_LIMIT_MIN_CHUNK = 4096
+# Seconds presigned URLs are valid for, at most until the credentials
+# they are signed with expire
+DEFAULT_PRESIGN_EXPIRES = 3600
+# Chunk index of a metadata file, published beside it
+DELTA_INDEX_SUFFIX = '.chunks'
+DEFAULT_DELTA_CHUNK_SIZE = 64 * 1024
+# fallocate() from libc, False where there is none
+FALLOCATE = None
+FALLOC_FL_KEEP_SIZE = 1
+# S3Proxy, the local signing and caching proxy
+DEFAULT_PROXY_ADDRESS = '127.0.0.1'
+DEFAULT_PROXY_PORT = 8093
+DEFAULT_PROXY_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+DEFAULT_PROXY_METADATA_EXPIRE = 60
+# Attempts of each request made by the proxy and mirror commands
+DEFAULT_STANDALONE_RETRIES = 5
+# S3Mirror, the local copy of a repository
+DEFAULT_MIRROR_JOBS = 8
+MIRROR_STATE_FILE = '.s3iam-mirror.json'
+# Updated once all the files it refers to are
+MIRROR_LAST = 'repodata/repomd.xml'
+EMPTY_PAYLOAD_HASH = hashlib.sha256('').hexdigest()
+# (access key, datestamp, region, service) -> (secret key, signing key, scope)
+SIGNING_KEYS = {}
+# Parsed endpoints, by URL
+ENDPOINTS = {}
+MAX_ENDPOINTS = 1024
 OPTIONAL_ATTRIBUTES = ['priority', 'base_persistdir', 'metadata_expire',
-                       'skip_if_unavailable', 'keepcache', 'priority']
+                       'skip_if_unavailable', 'keepcache', 'priority',
+                       'keepalive', 'timeout', 'max_connections']
 UNSUPPORTED_ATTRIBUTES = ['mirrorlist']
 
 
 def config_hook(conduit):
+    global CREDENTIAL_CACHE, CREDENTIAL_CACHE_MARGIN, PACKAGE_CACHE
+    global PREFETCH, PREFETCH_TYPES
+    CREDENTIAL_CACHE = conduit.confString('main', 'credential_cache', default=None)
+    CREDENTIAL_CACHE_MARGIN = conduit.confInt('main', 'credential_cache_margin',
+                                              default=CREDENTIAL_CACHE_MARGIN)
+    METADATA.timeout = conduit.confFloat('main', 'metadata_timeout',
+                                         default=METADATA_TIMEOUT)
+    package_cache = conduit.confString('main', 'package_cache', default=None)
+    if package_cache:
+        size = conduit.confString('main', 'package_cache_size', default=None)
+        if size:
+            size = yum.config.BytesOption().parse(size)
+        PACKAGE_CACHE = PackageCache(package_cache,
+                                     size or DEFAULT_PACKAGE_CACHE_SIZE)
+    PREFETCH = conduit.confBool('main', 'prefetch', default=False)
+    prefetch_types = conduit.confString('main', 'prefetch_types', default=None)
+    if prefetch_types:
+        PREFETCH_TYPES = prefetch_types.replace(',', ' ').split()
+
     yum.config.RepoConf.s3_enabled = yum.config.BoolOption(False)
     yum.config.RepoConf.region = yum.config.Option()
     yum.config.RepoConf.key_id = yum.config.Option()
@@ -62,38 +184,457 @@ def config_hook(conduit):
     )
     yum.config.RepoConf.backoff = yum.config.Option()
     yum.config.RepoConf.delay = yum.config.Option()
+    yum.config.RepoConf.max_delay = yum.config.Option()
+    yum.config.RepoConf.pool_size = yum.config.IntOption()
+    yum.config.RepoConf.multipart_threshold = yum.config.BytesOption()
+    yum.config.RepoConf.multipart_chunksize = yum.config.BytesOption()
+    yum.config.RepoConf.buffer_size = yum.config.BytesOption()
+    yum.config.RepoConf.delta_metadata = yum.config.BoolOption(False)
+    yum.config.RepoConf.presign = yum.config.BoolOption(False)
+    yum.config.RepoConf.presign_expires = yum.config.IntOption()
+    yum.config.RepoConf.trace_file = yum.config.Option()
+
+
+BUCKET_PATTERN = r'[a-z0-9][a-z0-9-.]{1,61}?[a-z0-9]'
+REGION_PATTERN = r'[a-z]{2}(?:-[a-z]+)+-[0-9]+|external-1'
+# http://docs.aws.amazon.com/AmazonS3/latest/dev/UsingBucket.html
+# http://docs.aws.amazon.com/general/latest/gr/s3.html
+ENDPOINT_RE = re.compile(r'''^(?P<scheme>https?|s3)://
+    (?:
+        # <bucket>.s3[-fips][.dualstack][.-<region>].amazonaws.com[.cn],
+        # or without the bucket for path-style requests. Interface
+        # endpoints are (bucket.)vpce-<id>.s3.<region>.vpce.amazonaws.com.
+        (?:(?P<bucket>%(bucket)s)[.])??
+        (?P<endpoint>
+            (?:(?:bucket[.])?vpce-[a-z0-9-]+[.])?
+            s3(?:-fips)?(?:[.-]dualstack)?(?:[.-](?P<region>%(region)s))?
+            (?:[.]vpce)?[.]amazonaws[.]com(?P<cn>[.]cn)?
+        )
+      | # Any other host is a custom endpoint, path-style only
+        (?P<custom>(?![^/?#:]*[.]amazonaws[.]com(?:[.]cn)?(?:[:/?#]|$))[^/?#:@]+)
+    )
+    (?P<port>:[0-9]+)?
+    (?P<path>(?:/(?P<path_bucket>%(bucket)s)(?=[/?#]|$))?(?P<key>(?:[/?#].*)?))$
+''' % {'bucket': BUCKET_PATTERN, 'region': REGION_PATTERN}, re.X)
 
 
-def parse_url(url):
-    # http://docs.aws.amazon.com/AmazonS3/latest/dev/UsingBucket.html
-    url = url[0] if isinstance(url, list) else url
+class Endpoint(collections.namedtuple('Endpoint', [
+        'scheme', 'host', 'bucket', 'region', 'style', 'partition', 'path'])):
+    """S3 URL split into endpoint and bucket.
 
-    # http[s]://<bucket>.s3.amazonaws.com
-    m = re.match(r'(http|https|s3)://([a-z0-9][a-z0-9-.]{1,61}[a-z0-9])[.]s3[.]amazonaws[.]com(.*)$', url)
-    if m:
-        return (m.group(2), None, m.group(3))
+    style is 'virtual' when the bucket is part of host, 'path' when it
+    is the first component of the URL path; path is what follows the
+    bucket. partition is None for custom endpoints.
+    """
 
-    # http[s]://<bucket>.s3-<aws-region>.amazonaws.com
-    m = re.match(r'(http|https|s3)://([a-z0-9][a-z0-9-.]{1,61}[a-z0-9])[.]s3-([a-z0-9-]+)[.]amazonaws[.]com(.*)$', url)
-    if m:
-        return (m.group(2), m.group(3), m.group(4))
+    __slots__ = ()
 
-    # http[s]://s3.amazonaws.com/<bucket>
-    m = re.match(r'(http|https|s3)://s3[.]amazonaws[.]com/([a-z0-9][a-z0-9-.]{1,61}[a-z0-9])(.*)$', url)
-    if m:
-        return (m.group(2), 'us-east-1', m.group(3))
+    @property
+    def url(self):
+        if self.style == 'virtual':
+            return '%s://%s%s' % (self.scheme, self.host, self.path)
+        return '%s://%s/%s%s' % (self.scheme, self.host, self.bucket, self.path)
 
-    # http[s]://s3.cn-north-1.amazonaws.com.cn/<bucket>
-    m = re.match(r'(http|https|s3)://s3[.]cn-north-1[.]amazonaws[.]com[.]cn/([a-z0-9][a-z0-9-.]{1,61}[a-z0-9])(.*)$', url)
-    if m:
-        return (m.group(2), 'cn-north-1', m.group(3))
+    def path_style(self):
+        """The same location, addressed path-style."""
+        if self.style == 'path':
+            return self
+        return self._replace(host=self.host[len(self.bucket) + 1:],
+                             style='path')
 
-    # http[s]://s3-<region>.amazonaws.com/<bucket>
-    m = re.match(r'(http|https|s3)://s3-([a-z0-9-]+)[.]amazonaws[.]com/([a-z0-9][a-z0-9-.]{1,61}[a-z0-9])(.*)$', url)
-    if m:
-        return (m.group(3), m.group(2), m.group(4))
 
-    return (None, None, None)
+def parse_endpoint(url):
+    """Parse an S3 URL into an Endpoint, None if it isn't one."""
+    url = url[0] if isinstance(url, list) else url
+    try:
+        return ENDPOINTS[url]
+    except KeyError:
+        pass
+
+    endpoint = None
+    m = ENDPOINT_RE.match(url)
+    if m and not (m.group('custom') and m.group('scheme') == 's3'):
+        host = m.group(m.group('custom') and 'custom' or 'endpoint')
+        region = m.group('region')
+        if region == 'external-1':
+            region = 'us-east-1'
+        if m.group('custom'):
+            partition = None
+        elif m.group('cn'):
+            partition = 'aws-cn'
+        elif region and region.startswith('us-gov-'):
+            partition = 'aws-us-gov'
+        else:
+            partition = 'aws'
+        # s3:// is https, so is plain http to AWS.
+        scheme = 'https' if partition else m.group('scheme')
+
+        if m.group('bucket'):
+            host = m.group('bucket') + '.' + host
+            bucket, style, path = m.group('bucket'), 'virtual', m.group('path')
+        else:
+            if partition == 'aws' and region is None:
+                region = 'us-east-1'
+            bucket, style, path = m.group('path_bucket'), 'path', m.group('key')
+        if bucket is not None:
+            endpoint = Endpoint(scheme, host + (m.group('port') or ''),
+                                bucket, region, style, partition, path)
+
+    if len(ENDPOINTS) >= MAX_ENDPOINTS:
+        ENDPOINTS.clear()
+    ENDPOINTS[url] = endpoint
+    return endpoint
+
+
+def parse_url(url):
+    """(bucket, region, path) of an S3 URL, (None, None, None) if it
+    isn't one."""
+    endpoint = parse_endpoint(url)
+    if endpoint is None:
+        return (None, None, None)
+    return (endpoint.bucket, endpoint.region, endpoint.path)
+
+
+def parse_baseurls(repoid, urls):
+    """Endpoints of the baseurl(s) urls of repository repoid. Raises
+    PluginYumExit if one isn't an S3 URL or there are none."""
+    if not isinstance(urls, list):
+        urls = [urls]
+    endpoints = []
+    for url in urls:
+        endpoint = parse_endpoint(url)
+        if endpoint is None:
+            msg = "s3iam: unable to parse url %s'" % url
+            raise yum.plugins.PluginYumExit(msg)
+        if endpoint.style == 'virtual' and '.' in endpoint.bucket:
+            # The wildcard certificate doesn't match dotted bucket names
+            endpoint = endpoint.path_style()
+        endpoints.append(endpoint)
+    if not endpoints:
+        msg = "s3iam: repository '%s' has no baseurl" % repoid
+        raise yum.plugins.PluginYumExit(msg)
+    return endpoints
+
+
+def canonical_query(params):
+    """Query string of (name, value) pairs params, in the canonical form
+    of AWS signature version 4."""
+    return '&'.join('%s=%s' % (urllib2.quote(name, safe='-_.~'),
+                               urllib2.quote(value, safe='-_.~'))
+                    for name, value in sorted(params))
+
+
+def parse_expiration(value):
+    """Convert an ISO 8601 UTC timestamp, as found in AWS temporary
+    credentials, to seconds since the epoch."""
+    value = value.split('.')[0].rstrip('Z')
+    return calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+
+
+def _private(st):
+    """Whether the file of os.stat() result st is a regular file owned
+    by root and not accessible to anybody else."""
+    return (stat.S_ISREG(st.st_mode) and st.st_uid == 0 and
+            not st.st_mode & 0077)
+
+
+def _lock_credential_cache(operation):
+    """Open and flock() the lock file of the credential cache, return
+    its file descriptor or None.
+
+    The cache holds secrets, so it is only used by root. It is replaced
+    by a rename when written, which is why the lock is taken on a file
+    of its own, CREDENTIAL_CACHE + '.lock'. Neither is opened through a
+    symbolic link, nor used unless owned by root and private.
+    """
+    if not CREDENTIAL_CACHE or os.geteuid() != 0:
+        return None
+    try:
+        fd = os.open(CREDENTIAL_CACHE + '.lock',
+                     os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0600)
+    except OSError:
+        return None
+    if not _private(os.fstat(fd)):
+        os.close(fd)
+        return None
+    fcntl.flock(fd, operation)
+    return fd
+
+
+def _load_credential_cache():
+    """Entries of the credential cache, None if it can't be trusted.
+    Called with the lock held."""
+    try:
+        fd = os.open(CREDENTIAL_CACHE, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError, e:
+        return {} if e.errno == errno.ENOENT else None
+    f = os.fdopen(fd)
+    try:
+        if not _private(os.fstat(fd)):
+            return None
+        try:
+            cache = json.loads(f.read() or '{}')
+        except ValueError:
+            return {}
+        return cache if isinstance(cache, dict) else {}
+    finally:
+        f.close()
+
+
+def read_cached_credentials(source):
+    """Credentials cached for `source` by any yum process, unless they
+    expire within CREDENTIAL_CACHE_MARGIN seconds."""
+    lock = _lock_credential_cache(fcntl.LOCK_SH)
+    if lock is None:
+        return None
+    try:
+        try:
+            data = _load_credential_cache()[source]
+            if parse_expiration(data['Expiration']) - CREDENTIAL_CACHE_MARGIN > time.time():
+                return data
+        except (KeyError, TypeError, ValueError):
+            pass
+        return None
+    finally:
+        os.close(lock)
+
+
+def write_cached_credentials(source, data):
+    """Store credentials for `source`, replacing expired entries.
+
+    The new contents are written to a temporary file that is renamed
+    over the cache, so a link planted at its path is replaced rather
+    than written through.
+    """
+    lock = _lock_credential_cache(fcntl.LOCK_EX)
+    if lock is None:
+        return
+    try:
+        cache = _load_credential_cache()
+        if cache is None:
+            return
+        now = time.time()
+        for key, value in cache.items():
+            try:
+                if parse_expiration(value['Expiration']) < now:
+                    del cache[key]
+            except (ValueError, KeyError, TypeError):
+                del cache[key]
+        cache[source] = data
+        # mkstemp() creates the file with mode 0600
+        fd, temp = tempfile.mkstemp(
+            prefix=os.path.basename(CREDENTIAL_CACHE) + '.',
+            dir=os.path.dirname(os.path.abspath(CREDENTIAL_CACHE)))
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(json.dumps(cache))
+            finally:
+                f.close()
+            os.rename(temp, CREDENTIAL_CACHE)
+        except:
+            os.unlink(temp)
+            raise
+    finally:
+        os.close(lock)
+
+
+def repo_option(repo, name, default):
+    """Value of option `name` of `repo`, or `default` when unset or when
+    the grabber was constructed from a plain URL."""
+    if isinstance(repo, basestring):
+        return default
+    value = getattr(repo, name, None)
+    return default if value is None else value
+
+
+def run_parallel(func, items, size):
+    """Call func(item) for every item using up to `size` threads.
+    The first exception raised by func is re-raised."""
+    items = list(items)
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+    errors = []
+
+    def work():
+        while not errors:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                func(item)
+            except Exception, e:
+                errors.append(e)
+
+    threads = []
+    for i in range(min(size, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # join() with a timeout so that KeyboardInterrupt is not blocked.
+        while thread.is_alive():
+            thread.join(1)
+    if errors:
+        raise errors[0]
+
+
+def new_hash(checksum_type):
+    """hashlib object for a yum checksum type ('sha' is SHA-1)."""
+    if checksum_type == 'sha':
+        checksum_type = 'sha1'
+    return hashlib.new(checksum_type)
+
+
+def hash_file(digest, filename, size=None):
+    """Update digest with the content of filename, or its first `size`
+    bytes."""
+    f = open(filename, 'rb')
+    try:
+        remaining = size
+        while remaining is None or remaining > 0:
+            amt = BUFFER_SIZE if remaining is None else min(BUFFER_SIZE, remaining)
+            buff = f.read(amt)
+            if not buff:
+                break
+            digest.update(buff)
+            if remaining is not None:
+                remaining -= len(buff)
+    finally:
+        f.close()
+
+
+def file_checksum(checksum_type, filename):
+    digest = new_hash(checksum_type)
+    hash_file(digest, filename)
+    return digest.hexdigest()
+
+
+def preallocate(f, size):
+    """Reserve `size` bytes of disk for file f, so that a full disk is
+    noticed before downloading and the file isn't fragmented.
+
+    The file's size is kept (Linux fallocate() with FALLOC_FL_KEEP_SIZE,
+    unlike posix_fallocate()), since partial downloads are resumed from
+    their size. Does nothing where that isn't supported.
+    """
+    global FALLOCATE
+    if FALLOCATE is None:
+        FALLOCATE = False
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            FALLOCATE = libc.fallocate64
+            FALLOCATE.argtypes = [ctypes.c_int, ctypes.c_int,
+                                  ctypes.c_longlong, ctypes.c_longlong]
+        except (ImportError, OSError, AttributeError):
+            pass
+    if not FALLOCATE or size <= 0:
+        return
+    if FALLOCATE(f.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        import ctypes
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            raise IOError(err, os.strerror(err), f.name)
+
+
+def etag_checksum(info):
+    """('md5', digest) of an object from the ETag of a response, None
+    unless the ETag is its MD5 (it isn't for multipart uploads and
+    objects encrypted with KMS or customer keys)."""
+    etag = (info.getheader('ETag') or '').strip('"')
+    if (not re.match(r'^[0-9a-f]{32}$', etag) or
+            (info.getheader('x-amz-server-side-encryption') or '').startswith('aws:kms') or
+            info.getheader('x-amz-server-side-encryption-customer-algorithm')):
+        return None
+    return ('md5', etag)
+
+
+def chunk_hashes(filename, chunk_size):
+    """SHA-256 of each chunk_size bytes of filename."""
+    hashes = []
+    f = open(filename, 'rb')
+    try:
+        buff = f.read(chunk_size)
+        while buff:
+            hashes.append(hashlib.sha256(buff).hexdigest())
+            buff = f.read(chunk_size)
+    finally:
+        f.close()
+    return hashes
+
+
+def write_chunk_index(filename, chunk_size=DEFAULT_DELTA_CHUNK_SIZE):
+    """Write the chunk index of metadata file filename, which lets
+    clients with delta_metadata fetch only the chunks that changed
+    since the version they have."""
+    index = {
+        'size': os.path.getsize(filename),
+        'chunk_size': chunk_size,
+        'checksum': ['sha256', file_checksum('sha256', filename)],
+        'chunks': chunk_hashes(filename, chunk_size),
+    }
+    f = open(filename + DELTA_INDEX_SUFFIX, 'w')
+    try:
+        json.dump(index, f)
+    finally:
+        f.close()
+
+
+def metadata_family(name):
+    """Name of metadata file `name` without its checksum prefix, the
+    same for all versions of the file."""
+    return re.sub(r'^[0-9a-f]{32,}-', '', name)
+
+
+def link_or_copy(src, dst):
+    """Hard link src to dst, copying it when a link isn't possible.
+    An existing dst is replaced, never written through."""
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def run_callback(callback, obj):
+    """Call a urlgrabber-style callback, either a callable or a
+    (func, args, kwargs) tuple."""
+    if callback is None:
+        return None
+    if callable(callback):
+        return callback(obj)
+    func, args, kwargs = callback
+    return func(obj, *args, **kwargs)
+
+
+def parallel_wait():
+    """Wait for downloads queued with async=True on any S3Grabber."""
+    for workers in WorkerPool.instances[:]:
+        workers.wait()
+
+
+def install_parallel_wait():
+    """Make urlgrabber.grabber.parallel_wait() wait for S3 downloads too.
+
+    yum queues package downloads with async=True and then calls
+    urlgrabber's parallel_wait(), which knows nothing about S3Grabber.
+    """
+    import urlgrabber.grabber
+    urlgrabber_wait = getattr(urlgrabber.grabber, 'parallel_wait', None)
+    if urlgrabber_wait is None or getattr(urlgrabber_wait, 's3iam', False):
+        return
+
+    def wait(*args, **kwargs):
+        parallel_wait()
+        return urlgrabber_wait(*args, **kwargs)
+    wait.s3iam = True
+    urlgrabber.grabber.parallel_wait = wait
 
 
 def replace_repo(repos, repo):
@@ -106,6 +647,9 @@ def prereposetup_hook(conduit):
 
     if 'DISABLE_YUM_S3_IAM' in os.environ and os.environ['DISABLE_YUM_S3_IAM']:
         return
+    # Repositories are replaced even in cache-only mode (yum -C), where
+    # yum would reject s3:// baseurls; their grabber is never set up then.
+    cache_only = conduit.getConf().cache
 
     repos = conduit.getRepos()
     for repo in repos.listEnabled():
@@ -118,6 +662,91 @@ def prereposetup_hook(conduit):
             repo.s3_enabled = 1
         if isinstance(repo, YumRepository) and repo.s3_enabled:
             replace_repo(repos, repo)
+            if not cache_only:
+                install_parallel_wait()
+
+
+def postreposetup_hook(conduit):
+    """Prefetch the metadata of S3 repositories, if enabled."""
+    if not PREFETCH:
+        return
+    repos = [repo for repo in conduit.getRepos().listEnabled()
+             if isinstance(repo, S3Repository) and not repo.cache and
+             not repo._metadataCurrent()]
+    if repos:
+        prefetch_metadata(repos, conduit)
+
+
+def close_hook(conduit):
+    """Remove the prefetched copies of repomd.xml yum didn't use."""
+    while PREFETCHED:
+        PREFETCHED.pop().discard_prefetched()
+
+
+def prefetch_metadata(repos, conduit):
+    """Download repomd.xml of all repos at once, then the PREFETCH_TYPES
+    files it lists, into the repositories' cache directories.
+
+    yum then reads the files from there instead of downloading them one
+    after the other; repomd.xml is handed to the grabber's urlgrab() of
+    it. Failures are only logged, yum fetches what is missing.
+
+    The files are checked against the checksums in repomd.xml but, not
+    being packages, are kept out of PACKAGE_CACHE.
+    """
+    import yum.repoMDObject
+
+    def attempt(func):
+        def wrapper(item):
+            try:
+                func(item)
+            except Exception, e:
+                conduit.info(3, 's3iam: prefetch failed: %s' % e)
+        return wrapper
+
+    files = []
+    lock = threading.Lock()
+
+    def fetch_repomd(repo):
+        # Copies left behind by a run that was killed
+        for name in os.listdir(repo.cachedir):
+            if name.startswith('repomd') and name.endswith('.s3iam.xml'):
+                os.unlink(os.path.join(repo.cachedir, name))
+        fd, filename = tempfile.mkstemp(prefix='repomd', suffix='.s3iam.xml',
+                                        dir=repo.cachedir)
+        os.close(fd)
+        try:
+            repo.grab.urlgrab(repo.repoMDFile, filename)
+            repomd = yum.repoMDObject.RepoMD(repo.id, filename)
+        except:
+            os.unlink(filename)
+            raise
+        repo.grab.prefetched[repo.repoMDFile] = filename
+        with lock:
+            PREFETCHED.append(repo.grab)
+        types = repomd.fileTypes()
+        for mdtype in PREFETCH_TYPES:
+            if mdtype not in types:
+                mdtype = mdtype.rsplit('_', 1)[0]
+                if mdtype not in types:
+                    continue
+            data = repomd.getData(mdtype)
+            local = os.path.join(repo.cachedir, os.path.basename(data.location[1]))
+            if not os.path.exists(local):
+                with lock:
+                    files.append((repo, data.location[1], local, data.checksum))
+
+    def fetch_file(item):
+        repo, url, local, checksum = item
+        try:
+            repo.grab.urlgrab(url, local, checksum=checksum, cache=False)
+        except:
+            if os.path.exists(local):
+                os.unlink(local)
+            raise
+
+    run_parallel(attempt(fetch_repomd), repos, PREFETCH_THREADS)
+    run_parallel(attempt(fetch_file), files, PREFETCH_THREADS)
 
 
 class S3Repository(YumRepository):
@@ -126,21 +755,11 @@ class S3Repository(YumRepository):
     def __init__(self, repoid, repo):
         super(S3Repository, self).__init__(repoid)
 
-        bucket, region, path = parse_url(repo.baseurl)
-
-        if bucket is None:
-            msg = "s3iam: unable to parse url %s'" % repo.baseurl
-            raise yum.plugins.PluginYumExit(msg)
-
-        if region and region != 'us-east-1':
-            self.baseurl = "https://s3-%s.amazonaws.com/%s%s" % (region, bucket, path)
-            if 'cn-north-1' in region:
-                self.baseurl = "https://s3.cn-north-1.amazonaws.com.cn/%s%s" % (bucket, path)
-        else:
-            self.baseurl = "https://%s.s3.amazonaws.com%s" % (bucket, path)
+        endpoints = parse_baseurls(repoid, repo.baseurl)
+        self.baseurl = [endpoint.url for endpoint in endpoints]
 
         self.name = repo.name
-        self.region = repo.region if repo.region else region
+        self.region = repo.region if repo.region else endpoints[0].region
         self.basecachedir = repo.basecachedir
         self.gpgcheck = repo.gpgcheck
         self.gpgkey = repo.gpgkey
@@ -152,6 +771,17 @@ class S3Repository(YumRepository):
         self.retries = repo.retries
         self.backoff = repo.backoff
         self.delay = repo.delay
+        self.max_delay = repo.max_delay
+        self.pool_size = repo.pool_size
+        self.multipart_threshold = repo.multipart_threshold
+        self.multipart_chunksize = repo.multipart_chunksize
+        self.buffer_size = repo.buffer_size
+        self.throttle = repo.throttle
+        self.bandwidth = repo.bandwidth
+        self.delta_metadata = repo.delta_metadata
+        self.presign = repo.presign
+        self.presign_expires = repo.presign_expires
+        self.trace_file = repo.trace_file
 
         for attr in OPTIONAL_ATTRIBUTES:
             if hasattr(repo, attr):
@@ -169,10 +799,7 @@ class S3Repository(YumRepository):
             proxy_config['http'] = os.environ['http_proxy']
         if repo.proxy and repo.proxy != '__none__':
             proxy_config['https'] = proxy_config['http'] = repo.proxy
-        if proxy_config:
-            proxy = urllib2.ProxyHandler(proxy_config)
-            opener = urllib2.build_opener(proxy)
-            urllib2.install_opener(opener)
+        self.proxy_config = proxy_config
 
         self.iamrole = None
         self.grabber = None
@@ -180,103 +807,960 @@ class S3Repository(YumRepository):
 
     @property
     def grabfunc(self):
+        if self.presign:
+            return self.grab.presigned
         raise NotImplementedError("grabfunc called, when it shouldn't be!")
 
+    def _stock_grabber(self):
+        """urlgrabber's URLGrabber, set up as YumRepository sets up its
+        own, to fetch presigned URLs with."""
+        from urlgrabber.grabber import URLGrabber
+        opts = {}
+        if hasattr(self, '_default_grabopts'):
+            opts = self._default_grabopts()
+        opts.update(self._callback_options())
+        return URLGrabber(copy_local=getattr(self, 'copy_local', 0),
+                          reget='simple', **opts)
+
+    def _callback_options(self):
+        """urlgrabber options for the callbacks yum has set on the
+        repository, which it replaces after the grabber is created."""
+        return {'progress_obj': getattr(self, 'callback', None),
+                'failure_callback': getattr(self, 'failure_obj', None),
+                'interrupt_callback': getattr(self, 'interrupt_callback', None)}
+
+    def getPackage(self, package, checkfunc=None, text=None, cache=True, **kwargs):
+        # Let the grabber know the checksum from primary metadata
+        self.grab.checksums[package.relativepath] = package.returnIdSum()
+        self.grab.packages[package.relativepath] = package
+        return super(S3Repository, self).getPackage(
+            package, checkfunc=checkfunc, text=text, cache=cache, **kwargs)
+
+    def install_proxy(self):
+        """Send urllib2 requests through the configured proxy."""
+        if self.proxy_config:
+            proxy = urllib2.ProxyHandler(self.proxy_config)
+            opener = urllib2.build_opener(proxy)
+            urllib2.install_opener(opener)
+
     @property
     def grab(self):
+        # Set up on first use: most yum commands never download anything
         if not self.grabber:
+            self.install_proxy()
             self.grabber = S3Grabber(self)
+            if self.presign:
+                self.grabber.presigned = self._stock_grabber()
+                self.grabber.presigned_options = self._callback_options
             if self.access_id and self.secret_key:
                 self.grabber.set_credentials(self.access_id, self.secret_key)
-            elif self.delegated_role:
-                self.grabber.get_delegated_role_credentials(self.delegated_role)
             else:
-                self.grabber.get_role()
-                self.grabber.get_credentials()
+                if self.delegated_role:
+                    source = 'delegated_role:%s' % self.delegated_role
+                else:
+                    source = 'instance_role'
+                self.grabber.credential_source = source
+                self.grabber.refresh_credentials()
         return self.grabber
 
 
+class InstanceMetadata(object):
+    """Client for the EC2 instance metadata service (IMDS).
+
+    Requests carry an IMDSv2 session token, fetched once and reused for
+    its lifetime; instances that only speak IMDSv1 get plain requests,
+    and so do containers the token's response doesn't reach (as with a
+    hop limit of 1), as in botocore, until the token is asked for again
+    METADATA_RETRY_INTERVAL seconds later. All requests time out after
+    `timeout` seconds, and once IMDS has proven unreachable it isn't
+    asked again for METADATA_RETRY_INTERVAL seconds. The role name and
+    the availability zone don't change while yum runs, so they are only
+    read once.
+    """
+
+    def __init__(self, timeout=METADATA_TIMEOUT):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.token = None
+        self.token_expires = 0
+        self.unreachable = None
+        self.unreachable_until = 0
+        self.cache = {}
+
+    def _token(self):
+        with self.lock:
+            if time.time() < self.unreachable_until:
+                raise self.unreachable
+            if self.token is not None and time.time() < self.token_expires:
+                return self.token
+            request = urllib2.Request(
+                urlparse.urljoin(METADATA_URL, 'latest/api/token'),
+                headers={'X-aws-ec2-metadata-token-ttl-seconds':
+                         str(METADATA_TOKEN_TTL)})
+            request.get_method = lambda: 'PUT'
+            response = None
+            try:
+                try:
+                    response = urllib2.urlopen(request, timeout=self.timeout)
+                    self.token = response.read()
+                except urllib2.HTTPError:
+                    # IMDSv1 only
+                    self.token = ''
+                except (urllib2.URLError, socket.error):
+                    # Try IMDSv1, get() finds out whether IMDS is there
+                    self.token = ''
+                    self.token_expires = time.time() + METADATA_RETRY_INTERVAL
+                    return self.token
+                except Exception:
+                    self.token = ''
+            finally:
+                if response:
+                    response.close()
+            self.token_expires = time.time() + METADATA_TOKEN_TTL - 60
+            return self.token
+
+    def get(self, path, cache=False):
+        """Return the contents of metadata `path`."""
+        if cache and path in self.cache:
+            return self.cache[path]
+        token = self._token()
+        request = urllib2.Request(urlparse.urljoin(METADATA_URL, path))
+        if token:
+            request.add_header('X-aws-ec2-metadata-token', token)
+        response = None
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            data = response.read()
+        except urllib2.HTTPError:
+            raise
+        except (urllib2.URLError, socket.error), e:
+            if not token:
+                with self.lock:
+                    self.unreachable = e
+                    self.unreachable_until = time.time() + METADATA_RETRY_INTERVAL
+            raise
+        finally:
+            if response:
+                response.close()
+        if cache:
+            self.cache[path] = data
+        return data
+
+    def role(self):
+        return self.get('latest/meta-data/iam/security-credentials/', cache=True)
+
+    def availability_zone(self):
+        return self.get('latest/meta-data/placement/availability-zone', cache=True)
+
+
+METADATA = InstanceMetadata()
+
+
+class CredentialProvider(object):
+    """Credentials shared by all repositories of the process.
+
+    Credentials are kept per source (the instance role or a delegated
+    role ARN), so N repositories using the same one cost one lookup.
+    Temporary credentials are fetched again once they expire within
+    CREDENTIAL_CACHE_MARGIN seconds, and are also shared with other
+    processes through the on-disk credential cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.credentials = {}
+
+    def get(self, source, fetch, force=False):
+        """Return (credentials, refresh_at) for source, calling fetch()
+        to get new credentials when needed. refresh_at is the time after
+        which get() should be called again, None if never."""
+        with self.lock:
+            entry = self.credentials.get(source)
+            if (entry is None or force or
+                    (entry[1] is not None and time.time() >= entry[1])):
+                data = None
+                if not force:
+                    data = read_cached_credentials(source)
+                if data is None:
+                    data = fetch()
+                    if data.get('Expiration'):
+                        write_cached_credentials(source, data)
+                entry = (data, self.refresh_time(data))
+                self.credentials[source] = entry
+            return entry
+
+    def refresh_time(self, data):
+        if not data.get('Expiration'):
+            return None
+        now = time.time()
+        expires = parse_expiration(data['Expiration'])
+        # Fresh credentials can already be within the margin, don't
+        # fetch them again on every request then.
+        return max(expires - CREDENTIAL_CACHE_MARGIN, (now + expires) / 2)
+
+
+CREDENTIALS = CredentialProvider()
+
+
+class PackageCache(object):
+    """Packages shared between repositories, stored by checksum.
+
+    Entries are hard links to (or copies of) verified downloads, under
+    <directory>/<checksum type>/<checksum>. Once the cache grows past
+    max_size bytes the least recently used entries are removed.
+
+    The directory is only scanned for the first put() and when entries
+    have to be removed; in between its size is kept up to date as
+    entries are added and discarded.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_PACKAGE_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        # Bytes in the cache, None until scanned
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _path(self, checksum):
+        checksum_type, value = checksum
+        if not (re.match(r'^[a-z0-9]+$', checksum_type) and
+                re.match(r'^[0-9a-f]+$', value)):
+            return None
+        return os.path.join(self.directory, checksum_type, value)
+
+    def get(self, checksum, filename):
+        """Link the cached package to filename, return False if there
+        is none."""
+        path = self._path(checksum)
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            link_or_copy(path, filename)
+            os.utime(path, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def put(self, checksum, filename, verified=False):
+        """Add downloaded filename, after checking its checksum unless
+        that was already done."""
+        path = self._path(checksum)
+        if path is None:
+            return
+        if not verified and file_checksum(checksum[0], filename) != checksum[1]:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+            link_or_copy(filename, tmp)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.rename(tmp, path)
+            added = os.path.getsize(path) - replaced
+        except (IOError, OSError):
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = evict_files(self.directory, self.max_size)
+                return
+            self.size += added
+            if self.size > self.max_size:
+                self.size = evict_files(self.directory, self.max_size)
+
+    def discard(self, checksum):
+        path = self._path(checksum)
+        if path is not None and os.path.exists(path):
+            size = os.path.getsize(path)
+            os.unlink(path)
+            with self.lock:
+                if self.size is not None:
+                    self.size -= size
+
+    def evict(self):
+        with self.lock:
+            self.size = evict_files(self.directory, self.max_size)
+
+
+def evict_files(directory, max_size, skip=()):
+    """Remove the least recently modified files under directory until
+    they add up to max_size bytes at most, and return their size. Files
+    whose name ends with one of skip are neither counted nor removed."""
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if skip and name.endswith(skip):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+    return total
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections, reused across requests.
+
+    At most `maxsize` idle connections are kept for each (scheme, host).
+    """
+
+    def __init__(self, maxsize=DEFAULT_POOL_SIZE, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def _connect(self, key):
+        scheme, host = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        if self.timeout:
+            return cls(host, timeout=self.timeout)
+        return cls(host)
+
+    def _acquire(self, key):
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop()
+        return None
+
+    def _release(self, key, conn, response):
+        """Return `conn` to the pool once `response` has been consumed."""
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, conn, request):
+        headers = dict(request.header_items())
+        # The signed host, whatever conn is connected to
+        headers['Host'] = request.get_host()
+        conn.request(request.get_method(), request.get_selector(),
+                     headers=headers)
+        return conn.getresponse()
+
+    def urlopen(self, request):
+        """Send urllib2 `request` over a pooled connection.
+
+        Mirrors urllib2.urlopen: returns a file-like response and raises
+        HTTPError for non-2xx responses and URLError for socket errors.
+        Both carry a `timings` dict: seconds spent connecting (None on a
+        reused connection) and until the response headers arrived.
+        """
+        started = time.time()
+        timings = {'connect': None}
+        key = (request.get_type(), request.get_host())
+        conn = self._acquire(key)
+        try:
+            if conn is not None:
+                try:
+                    response = self._send(conn, request)
+                except (httplib.HTTPException, socket.error):
+                    # The server may have dropped the idle connection,
+                    # retry once on a fresh one.
+                    conn.close()
+                    conn = None
+            if conn is None:
+                connecting = time.time()
+                conn = self._connect(key)
+                # Connect (and handshake) here rather than in request(),
+                # to time it separately.
+                conn.connect()
+                timings['connect'] = time.time() - connecting
+                response = self._send(conn, request)
+        except (httplib.HTTPException, socket.error), e:
+            if conn is not None:
+                conn.close()
+            raise urllib2.URLError(e)
+        timings['first_byte'] = time.time() - started
+
+        url = request.get_full_url()
+        if not 200 <= response.status < 300:
+            body = response.read()
+            self._release(key, conn, response)
+            e = urllib2.HTTPError(url, response.status, response.reason,
+                                  response.msg, StringIO.StringIO(body))
+            e.timings = timings
+            raise e
+        response = PooledResponse(self, key, conn, response, url)
+        response.timings = timings
+        return response
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle = {}
+
+
+class PooledResponse(object):
+    """File-like response that hands its connection back to the pool."""
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.code = response.status
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def readinto(self, buff):
+        """Read up to len(buff) bytes of the body into bytearray buff.
+
+        httplib reads the status line and headers from the socket
+        unbuffered, so a body of known length is received straight into
+        buff; other bodies go through read().
+        """
+        response = self.response
+        fp = response.fp
+        if fp is None:
+            return 0
+        if (response.chunked or response.length is None or
+                getattr(fp, '_rbufsize', None) != 1 or fp._rbuf.tell()):
+            data = response.read(len(buff))
+            buff[:len(data)] = data
+            return len(data)
+        amt = min(len(buff), response.length)
+        n = fp._sock.recv_into(buff, amt) if amt else 0
+        if amt and not n:
+            response.close()
+            raise httplib.IncompleteRead('')
+        response.length -= n
+        if not response.length:
+            response.close()
+        return n
+
+    def info(self):
+        return self.response.msg
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        if self.conn is not None:
+            self.pool._release(self.key, self.conn, self.response)
+            self.conn = None
+
+
+class WorkerPool(object):
+    """Run jobs on up to `size` daemon threads.
+
+    Completion callbacks are not run by the workers but by whoever calls
+    wait(), so that yum's callbacks stay in the main thread.
+    """
+
+    instances = []
+
+    def __init__(self, size):
+        self.size = size
+        self.jobs = Queue.Queue()
+        self.done = Queue.Queue()
+        self.threads = []
+        self.pending = 0
+        self.lock = threading.Lock()
+        WorkerPool.instances.append(self)
+
+    def submit(self, func, args, callback=None):
+        """Queue func(*args); callback(result, exception) is run by wait()."""
+        with self.lock:
+            self.pending += 1
+            if len(self.threads) < min(self.size, self.pending):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.jobs.put((func, args, callback))
+
+    def _work(self):
+        while True:
+            func, args, callback = self.jobs.get()
+            result = exception = None
+            try:
+                result = func(*args)
+            except Exception, e:
+                exception = e
+            self.done.put((callback, result, exception))
+
+    def wait(self):
+        """Block until all submitted jobs have finished, running their
+        callbacks. Exceptions of jobs without a callback are re-raised."""
+        while True:
+            with self.lock:
+                if self.pending == 0:
+                    return
+            try:
+                # Poll so that KeyboardInterrupt is not blocked.
+                callback, result, exception = self.done.get(True, 1)
+            except Queue.Empty:
+                continue
+            with self.lock:
+                self.pending -= 1
+            if callback is not None:
+                callback(result, exception)
+            elif exception is not None:
+                raise exception
+
+
+class RetryPolicy(object):
+    """Decides whether a failed request is tried again, and when.
+
+    Network errors, server errors (5xx) and throttling are retried after
+    a random delay between 0 and min(max_delay, delay * backoff ** n)
+    ("full jitter"), so that hosts failing together don't retry
+    together, or after the time asked for with Retry-After. ExpiredToken
+    errors are retried at once with refreshed credentials. Other client
+    errors (403, 404, ...) are final.
+    """
+
+    RETRYABLE_CODES = frozenset(['RequestTimeout', 'SlowDown', 'Throttling',
+                                 'ThrottlingException', 'RequestLimitExceeded',
+                                 'InternalError', 'ServiceUnavailable'])
+    EXPIRED_CODES = frozenset(['ExpiredToken', 'TokenRefreshRequired'])
+
+    def __init__(self, attempts, delay=DEFAULT_DELAY, backoff=DEFAULT_BACKOFF,
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+
+    def classify(self, e):
+        """'retry', 'refresh' (credentials, then retry) or 'fatal'."""
+        if not isinstance(e, urllib2.HTTPError):
+            return 'retry'
+        code = s3_error_code(e)
+        if code in self.EXPIRED_CODES:
+            return 'refresh'
+        # 412: the object changed while downloaded, the transfer restarts
+        if (e.code >= 500 or e.code in (408, 412, 429) or
+                code in self.RETRYABLE_CODES):
+            return 'retry'
+        return 'fatal'
+
+    def wait_time(self, attempt, e):
+        """Seconds to wait after failed attempt number `attempt`."""
+        headers = getattr(e, 'hdrs', None)
+        retry_after = headers and headers.getheader('Retry-After')
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0), self.max_delay)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_delay,
+                                     self.delay * self.backoff ** (attempt - 1)))
+
+
+def s3_error_code(e):
+    """S3's error code from the XML body of HTTPError e, '' if none."""
+    if not hasattr(e, 's3_code'):
+        try:
+            body = e.read(4096) or ''
+        except Exception:
+            body = ''
+        m = re.search(r'<Code>([^<]+)</Code>', body)
+        e.s3_code = m.group(1) if m else ''
+    return e.s3_code
+
+
+class Replica(object):
+    """One of the baseurls of a repository, and how it has performed.
+
+    latency (seconds until the response headers arrive) and throughput
+    (bytes per second) are moving averages over recent requests. After a
+    failure the replica is avoided for REPLICA_DOWNTIME seconds, twice as
+    long after each further consecutive failure.
+    """
+
+    WEIGHT = 0.3
+
+    def __init__(self, baseurl, region=None):
+        # Ensure urljoin doesn't ignore base path:
+        if not baseurl.endswith('/'):
+            baseurl += '/'
+        self.baseurl = baseurl
+        # Parsed once, for signing requests to this endpoint
+        self.endpoint = parse_endpoint(baseurl)
+        self.region = region
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.down_until = 0
+        self.used = 0
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.WEIGHT * (value - average)
+
+    def observe(self, latency=None, throughput=None):
+        """Record a successful request."""
+        if latency is not None:
+            self.latency = self._average(self.latency, latency)
+        if throughput is not None:
+            self.throughput = self._average(self.throughput, throughput)
+        self.failures = 0
+        self.down_until = 0
+
+    def fail(self):
+        """Record a failed request, the replica is down for a while."""
+        self.failures += 1
+        self.down_until = time.time() + min(
+            REPLICA_MAX_DOWNTIME, REPLICA_DOWNTIME * 2 ** (self.failures - 1))
+
+    def cost(self):
+        """Expected seconds to fetch BUFFER_SIZE bytes."""
+        cost = self.latency or 0.0
+        if self.throughput:
+            cost += float(BUFFER_SIZE) / self.throughput
+        return cost
+
+
+class TokenBucket(object):
+    """Limit of `rate` bytes per second, shared by concurrent transfers.
+
+    Transfers take tokens for the bytes they receive, in chunks of at
+    most `chunk` bytes. Tokens taken beyond those in the bucket are paid
+    back by sleeping until it refills, after the transfers that were
+    already waiting, so each of them gets about the same share.
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.chunk = max(RATE_LIMIT_MIN_CHUNK, int(rate / RATE_LIMIT_SLICES))
+        self.tokens = float(self.chunk)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        """Take n tokens, sleeping until they are available."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.chunk,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def rate_limiter(throttle, bandwidth):
+    """The TokenBucket of the process for yum's throttle and bandwidth
+    options, None for no limit. As in urlgrabber, throttle is a rate in
+    bytes per second above 1, a fraction of bandwidth otherwise.
+    Repositories with the same limit share the same bucket."""
+    throttle = float(throttle or 0)
+    if throttle <= 1:
+        throttle *= float(bandwidth or 0)
+    if throttle <= 0:
+        return None
+    with RATE_LIMITERS_LOCK:
+        if throttle not in RATE_LIMITERS:
+            RATE_LIMITERS[throttle] = TokenBucket(throttle)
+        return RATE_LIMITERS[throttle]
+
+
+class TracedResponse(object):
+    """Response of a request made by `grabber`, which counts the bytes
+    read and reports the request to the grabber's hooks when closed."""
+
+    def __init__(self, grabber, request, response, started):
+        self.grabber = grabber
+        self.request = request
+        self.response = response
+        self.started = started
+        self.first_byte = time.time() - started
+        self.bytes = 0
+        self.closed = False
+        if hasattr(response, 'readinto'):
+            self.readinto = self._readinto
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def _readinto(self, buff):
+        n = self.response.readinto(buff)
+        self.bytes += n
+        return n
+
+    def read(self, amt=None):
+        if amt is None:
+            buff = self.response.read()
+        else:
+            buff = self.response.read(amt)
+        self.bytes += len(buff)
+        return buff
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.response.close()
+        finally:
+            self.grabber._trace_request(self.request, self.started,
+                                        response=self.response,
+                                        first_byte=self.first_byte,
+                                        size=self.bytes)
+
+
+class TraceFile(object):
+    """Grabber hook appending each event to `path` as a line of JSON."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = None
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.path, 'a')
+            self.f.write(line)
+            self.f.flush()
+
+
+class Transfer(object):
+    """Progress of a download from `url` into file `out`, kept across
+    retried attempts so that each one resumes where the last stopped."""
+
+    def __init__(self, url, out=None, start=0, end=None, etag=None,
+                 etag_file=None):
+        self.url = url
+        self.out = out
+        self.start = start
+        self.offset = start
+        self.end = end
+        self.etag = etag
+        self.etag_file = etag_file
+        self.total = None
+        self.last_modified = None
+        # Validators of a cached copy, for a conditional request
+        self.validators = None
+        self.not_modified = False
+        # Expected (checksum type, value) of the object and digest of
+        # the data written so far, when it is written sequentially
+        self.checksum = None
+        self.digest = None
+        self.verified = False
+
+    def restart_digest(self):
+        self.digest = new_hash(self.checksum[0]) if self.checksum else None
+        self.verified = False
+
+    def restart(self):
+        """Start over from the beginning of the object."""
+        self.offset = 0
+        self.etag = None
+        self.out.seek(0)
+        self.out.truncate()
+        self.restart_digest()
+
+    def set_etag(self, etag):
+        if not etag or etag == self.etag:
+            return
+        self.etag = etag
+        if self.etag_file:
+            f = open(self.etag_file, 'w')
+            try:
+                f.write(etag)
+            finally:
+                f.close()
+
+    def forget_etag(self):
+        if self.etag_file and os.path.exists(self.etag_file):
+            os.unlink(self.etag_file)
+        self.etag_file = None
+
+
+class Credentials(collections.namedtuple('Credentials', [
+        'access_key', 'secret_key', 'token'])):
+    """Credentials requests are signed with, replaced as a whole so that
+    a request is never signed with parts of two sets."""
+
+    __slots__ = ()
+
+
 class S3Grabber(object):
 
     def __init__(self, repo):
         """Initialize file grabber.
-        Note: currently supports only single repo.baseurl. So in case of a list
-              only the first item will be used.
+
+        Each of repo.baseurl is a Replica of the repository. Requests go
+        to the replica with the lowest latency and best throughput so
+        far, and are retried on another one when it fails, is throttled
+        or doesn't have the file. Replicas are signed for the region in
+        their URL; the first one, and any without a region, for
+        repo.region.
+
+        Callables in self.hooks are passed a dict for every event: each
+        'request' to S3 (status, bytes, attempt, timings of connect,
+        first byte and transfer), 'retry', 'credentials' fetched from
+        IMDS or STS and completed 'download'. With the trace_file option
+        set the events are appended to that file as JSON lines.
         """
         if isinstance(repo, basestring):
-            self.baseurl = repo
-            self.region = None
+            self.replicas = [Replica(repo)]
             self.retries = 0
+            self.backoff = DEFAULT_BACKOFF
+            self.delay = DEFAULT_DELAY
+            self.max_delay = DEFAULT_MAX_DELAY
+            proxied = bool(urllib2.getproxies())
         else:
             self.id = repo.id
-            self.region = repo.region
             self.retries = repo.retries
-            self.backoff = DEFAULT_BACKOFF if repo.backoff is None else repo.backoff
-            self.delay = DEFAULT_DELAY if repo.delay is None else repo.delay
-            if len(repo.baseurl) != 1:
-                msg = "%s: repository '%s' must" % (__file__, repo.id)
-                msg += 'have only one baseurl value'
+            self.backoff = DEFAULT_BACKOFF if repo.backoff is None else float(repo.backoff)
+            self.delay = DEFAULT_DELAY if repo.delay is None else float(repo.delay)
+            self.max_delay = float(repo_option(repo, 'max_delay', DEFAULT_MAX_DELAY))
+            if not repo.baseurl:
+                msg = "%s: repository '%s' has no baseurl" % (__file__, repo.id)
                 raise yum.plugins.PluginYumExit(msg)
-            else:
-                self.baseurl = repo.baseurl[0]
-        # Ensure urljoin doesn't ignore base path:
-        if not self.baseurl.endswith('/'):
-            self.baseurl += '/'
-        self.access_key = None
-        self.secret_key = None
-        self.token = None
+            self.replicas = []
+            for url in repo.baseurl:
+                replica = Replica(url, repo.region)
+                if self.replicas and replica.endpoint and replica.endpoint.region:
+                    replica.region = replica.endpoint.region
+                self.replicas.append(replica)
+            proxied = bool(getattr(repo, 'proxy_config', None))
+        # Requests made so far, for probing replicas
+        self.replica_requests = 0
+        self.credentials = Credentials(None, None, None)
+        self.expiration = None
+        self.credential_source = None
+        self.refresh_at = None
+        # Keep-alive connections can't be tunnelled through the proxy opener,
+        # so proxied repositories keep using urllib2 directly.
+        self.pool = None
+        pool_size = repo_option(repo, 'pool_size', DEFAULT_POOL_SIZE)
+        if repo_option(repo, 'keepalive', True) and pool_size > 0 and not proxied:
+            self.pool = ConnectionPool(pool_size, repo_option(repo, 'timeout', None))
+        self.max_connections = (repo_option(repo, 'max_connections', 0) or
+                                DEFAULT_MAX_CONNECTIONS)
+        self.multipart_threshold = repo_option(repo, 'multipart_threshold',
+                                               DEFAULT_MULTIPART_THRESHOLD)
+        self.multipart_chunksize = repo_option(repo, 'multipart_chunksize',
+                                               DEFAULT_MULTIPART_CHUNKSIZE)
+        self.buffer_size = repo_option(repo, 'buffer_size', BUFFER_SIZE)
+        self.rate_limiter = rate_limiter(repo_option(repo, 'throttle', 0),
+                                         repo_option(repo, 'bandwidth', 0))
+        self.delta_metadata = repo_option(repo, 'delta_metadata', False)
+        self.presign_expires = repo_option(repo, 'presign_expires',
+                                           DEFAULT_PRESIGN_EXPIRES)
+        # Grabber presigned URLs are handed to, in presign mode, and a
+        # function returning options to pass it on each call
+        self.presigned = None
+        self.presigned_options = None
+        self.metadata_dir = None
+        cachedir = repo_option(repo, 'cachedir', None)
+        if cachedir:
+            self.metadata_dir = os.path.join(cachedir, 's3iam-metadata')
+        self.workers = None
+        # Expected checksums of packages, by url
+        self.checksums = {}
+        # yum package objects, by url
+        self.packages = {}
+        # Files downloaded by prefetch_metadata(), by url
+        self.prefetched = {}
+        self.hooks = []
+        trace_file = repo_option(repo, 'trace_file', None)
+        if trace_file:
+            self.hooks.append(TraceFile(trace_file))
+        # Attempt number of the request made by the current thread
+        self.local = threading.local()
+
+    @property
+    def baseurl(self):
+        return self.replicas[0].baseurl
+
+    @property
+    def endpoint(self):
+        return self.replicas[0].endpoint
+
+    def _get_region(self):
+        return self.replicas[0].region
+
+    def _set_region(self, region):
+        self.replicas[0].region = region
+
+    region = property(_get_region, _set_region)
+
+    # Each of the credentials on its own, for callers that don't sign
+    def _credential_property(field):
+        def get(self):
+            return getattr(self.credentials, field)
+
+        def set(self, value):
+            self.credentials = self.credentials._replace(**{field: value})
+        return property(get, set)
+
+    access_key = _credential_property('access_key')
+    secret_key = _credential_property('secret_key')
+    token = _credential_property('token')
+    del _credential_property
 
     def get_role(self):
         """Read IAM role from AWS metadata store."""
-        request = urllib2.Request(
-            urlparse.urljoin(
-                "http://169.254.169.254",
-                "/latest/meta-data/iam/security-credentials/"
-            ))
-
         try:
-            response = urllib2.urlopen(request)
-            self.iamrole = (response.read())
+            self.iamrole = METADATA.role()
         except Exception:
-            response = None
             self.iamrole = ""
-        finally:
-            if response:
-                response.close()
 
     def get_credentials(self):
         """Read IAM credentials from AWS metadata store.
         Note: This method should be explicitly called after constructing new
               object, as in 'explicit is better than implicit'.
         """
-        request = urllib2.Request(
-            urlparse.urljoin(
-                urlparse.urljoin(
-                    "http://169.254.169.254/",
-                    "latest/meta-data/iam/security-credentials/",
-                ), self.iamrole))
-
+        access_key, secret_key, token = self.credentials
+        expiration = self.expiration
         try:
-            response = urllib2.urlopen(request)
-            data = json.loads(response.read())
-            self.access_key = data['AccessKeyId']
-            self.secret_key = data['SecretAccessKey']
-            self.token = data['Token']
+            data = json.loads(METADATA.get(
+                'latest/meta-data/iam/security-credentials/' + self.iamrole))
+            access_key = data['AccessKeyId']
+            secret_key = data['SecretAccessKey']
+            token = data['Token']
+            expiration = data.get('Expiration')
         except Exception:
-            response = None
-        finally:
-            if response:
-                response.close()
+            pass
 
-        if self.access_key is None and self.secret_key is None:
+        if access_key is None and secret_key is None:
             if "AWS_ACCESS_KEY_ID" in os.environ:
-                self.access_key = os.environ['AWS_ACCESS_KEY_ID']
+                access_key = os.environ['AWS_ACCESS_KEY_ID']
             if "AWS_SECRET_ACCESS_KEY" in os.environ:
-                self.secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
+                secret_key = os.environ['AWS_SECRET_ACCESS_KEY']
             if "AWS_SESSION_TOKEN" in os.environ:
-                self.token = os.environ['AWS_SESSION_TOKEN']
+                token = os.environ['AWS_SESSION_TOKEN']
+        self.credentials = Credentials(access_key, secret_key, token)
+        self.expiration = expiration
 
-        if self.access_key is None and self.secret_key is None:
+        if access_key is None and secret_key is None:
             if hasattr(self, 'name'):
                 msg = "Could not access AWS credentials, skipping repository '%s'" % (self.name)
             else:
@@ -286,9 +1770,44 @@ class S3Grabber(object):
             raise URLGrabError(7, msg)
 
     def set_credentials(self, access_key, secret_key):
-        self.access_key = access_key
-        self.secret_key = secret_key
-        self.token = None
+        self.credentials = Credentials(access_key, secret_key, None)
+        self.expiration = None
+
+    def refresh_credentials(self, force=False):
+        """Take credentials for self.credential_source from the
+        process-wide CREDENTIALS provider, which fetches them only when
+        no other grabber did or when they are about to expire."""
+        data, self.refresh_at = CREDENTIALS.get(
+            self.credential_source, self.fetch_credentials, force)
+        self.credentials = Credentials(data['AccessKeyId'],
+                                       data['SecretAccessKey'], data['Token'])
+        self.expiration = data['Expiration']
+
+    def fetch_credentials(self):
+        """Fetch credentials for self.credential_source from IMDS or STS."""
+        source = self.credential_source
+        started = time.time()
+        try:
+            if source.startswith('delegated_role:'):
+                self.get_delegated_role_credentials(source[len('delegated_role:'):])
+            else:
+                self.get_role()
+                self.get_credentials()
+        except Exception, e:
+            if self.hooks:
+                self._emit('credentials', duration=time.time() - started,
+                           error=str(e))
+            raise
+        if self.hooks:
+            self._emit('credentials', duration=time.time() - started,
+                       expiration=self.expiration)
+        credentials = self.credentials
+        return {
+            'AccessKeyId': credentials.access_key,
+            'SecretAccessKey': credentials.secret_key,
+            'Token': credentials.token,
+            'Expiration': self.expiration,
+        }
 
     def get_delegated_role_credentials(self, delegated_role):
         """Collect temporary credentials from AWS STS service. Uses
@@ -301,100 +1820,819 @@ class S3Grabber(object):
         sts_conn = boto.sts.connect_to_region(self.get_instance_region())
         assumed_role = sts_conn.assume_role(delegated_role, 'yum')
 
-        self.access_key = assumed_role.credentials.access_key
-        self.secret_key = assumed_role.credentials.secret_key
-        self.token = assumed_role.credentials.session_token
+        self.credentials = Credentials(assumed_role.credentials.access_key,
+                                       assumed_role.credentials.secret_key,
+                                       assumed_role.credentials.session_token)
+        self.expiration = assumed_role.credentials.expiration
 
     def get_instance_region(self):
         """Read region from AWS metadata store."""
-        request = urllib2.Request(
-            urlparse.urljoin(
-                "http://169.254.169.254",
-                "/latest/meta-data/placement/availability-zone"
-            ))
-
-        response = None
-        try:
-            response = urllib2.urlopen(request)
-            data = response.read()
-        finally:
-            if response:
-                response.close()
-        return data[:-1]
+        return METADATA.availability_zone()[:-1]
+
+    def _request(self, path, timeval=None, headers=None):
+        if self.refresh_at is not None and time.time() >= self.refresh_at:
+            self.refresh_credentials()
+        replica = self._choose_replica()
+        url = urlparse.urljoin(replica.baseurl, urllib2.quote(path))
+        return self._sign(urllib2.Request(url, headers=headers or {}),
+                          replica, timeval)
+
+    def _list_request(self, replica, token=None, timeval=None):
+        """Signed ListObjectsV2 request for the objects under the baseurl
+        of replica, from continuation token on. request.prefix is their
+        common prefix."""
+        if self.refresh_at is not None and time.time() >= self.refresh_at:
+            self.refresh_credentials()
+        endpoint = replica.endpoint
+        params = [('list-type', '2'), ('encoding-type', 'url'),
+                  ('prefix', endpoint.path[1:])]
+        if token:
+            params.append(('continuation-token', token))
+        url = '%s?%s' % (endpoint._replace(path='/').url, canonical_query(params))
+        request = self._sign(urllib2.Request(url), replica, timeval)
+        request.prefix = endpoint.path[1:]
+        return request
 
-    def _request(self, path, timeval=None):
-        url = urlparse.urljoin(self.baseurl, urllib2.quote(path))
-        request = urllib2.Request(url)
-        if self.region:
-            self.signV4(request, timeval)
+    def _sign(self, request, replica, timeval=None):
+        request.replica = self.local.replica = replica
+        if replica.region:
+            self.signV4(request, timeval, replica.region)
         else:
-            self.signV2(request, timeval)
+            self.signV2(request, timeval, replica.endpoint)
         return request
 
+    def _choose_replica(self):
+        """Replica for the next request: the cheapest of those that are
+        up and weren't tried yet by the current _retry(). Replicas are
+        tried once before being ranked, and every REPLICA_PROBE_INTERVAL
+        requests the least recently used one is, to keep measurements
+        current."""
+        replicas = self.replicas
+        if len(replicas) == 1:
+            return replicas[0]
+        now = time.time()
+        tried = getattr(self.local, 'tried', None) or ()
+        candidates = [r for r in replicas if r not in tried] or replicas
+        up = [r for r in candidates if r.down_until <= now]
+        if not up:
+            replica = min(candidates, key=lambda r: r.down_until)
+        else:
+            self.replica_requests += 1
+            unmeasured = [r for r in up if r.latency is None]
+            if unmeasured:
+                replica = unmeasured[0]
+            elif self.replica_requests % REPLICA_PROBE_INTERVAL == 0:
+                replica = min(up, key=lambda r: r.used)
+            else:
+                replica = min(up, key=Replica.cost)
+        replica.used = now
+        return replica
+
+    def _urlopen(self, request):
+        if self.pool is None:
+            return urllib2.urlopen(request)
+        return self.pool.urlopen(request)
+
+    def _open(self, request):
+        """Send request with _urlopen, reporting it to self.hooks and
+        its latency to the request's replica."""
+        started = time.time()
+        try:
+            response = self._urlopen(request)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            if self.hooks:
+                self._trace_request(request, started, error=e)
+            raise
+        replica = getattr(request, 'replica', None)
+        if replica is not None:
+            replica.observe(latency=time.time() - started)
+        if not self.hooks:
+            return response
+        return TracedResponse(self, request, response, started)
+
+    def _emit(self, event, **fields):
+        """Pass an event to each of self.hooks."""
+        fields['event'] = event
+        fields['time'] = time.time()
+        fields['repo'] = getattr(self, 'id', None)
+        fields['credential_source'] = self.credential_source or 'static'
+        for hook in self.hooks:
+            hook(fields)
+
+    def _trace_request(self, request, started, response=None, error=None,
+                       first_byte=None, size=0):
+        """Report a request to self.hooks. Connection timings are only
+        known for pooled connections."""
+        result = response if error is None else error
+        timings = getattr(result, 'timings', None) or {}
+        total = time.time() - started
+        self._emit('request', method=request.get_method(),
+                   url=request.get_full_url(),
+                   status=getattr(result, 'code', None), bytes=size,
+                   attempt=getattr(self.local, 'attempt', 1),
+                   reused=timings['connect'] is None if timings else None,
+                   connect=timings.get('connect'),
+                   first_byte=timings.get('first_byte', first_byte),
+                   transfer=None if first_byte is None else total - first_byte,
+                   total=total,
+                   error=None if error is None else str(error))
+
     def urlgrab(self, url, filename=None, **kwargs):
-        """urlgrab(url) copy the file to the local filesystem."""
+        """urlgrab(url) copy the file to the local filesystem.
+
+        With reget set, a partial filename left by an earlier download is
+        completed with a Range request, provided the object's ETag still
+        matches the one recorded when that download started.
+
+        With async=True the download is queued on a pool of
+        max_connections threads and the filename is returned at once;
+        checkfunc or failfunc run once it completes, from parallel_wait().
+
+        Packages whose checksum is known (from the checksum argument or
+        getPackage) are taken from the shared PACKAGE_CACHE when there,
+        and added to it otherwise, unless cache=False.
+
+        In presign mode (self.presigned set) files other than prefetched
+        ones are fetched by that grabber from a presigned URL instead,
+        with all of kwargs.
+        """
+        cache = kwargs.pop('cache', True)
+        if self.presigned is not None and url not in self.prefetched:
+            return self.presigned.urlgrab(self.presign(url), filename,
+                                          **self._presigned_kwargs(kwargs))
         request = self._request(url)
         if filename is None:
             filename = request.get_selector()
             if filename.startswith('/'):
                 filename = filename[1:]
+        checksum = kwargs.get('checksum') or self.checksums.get(url)
+        args = (url, filename, kwargs.get('reget'), checksum, cache)
 
-        response = None
-        retries = self.retries
-        delay = self.delay
-        out = open(filename, 'w+')
-        while retries > 0:
+        if kwargs.get('async'):
+            if self.workers is None:
+                self.workers = WorkerPool(self.max_connections)
+
+            def callback(cached, exception):
+                self._async_done(url, filename, kwargs, checksum, cached, exception)
+            self.workers.submit(self._grab, args, callback)
+            return filename
+
+        cached = self._grab(*args)
+        from urlgrabber.grabber import CallbackObject, URLGrabError
+        try:
+            run_callback(kwargs.get('checkfunc'),
+                         CallbackObject(url=url, filename=filename))
+        except URLGrabError:
+            if cached:
+                PACKAGE_CACHE.discard(checksum)
+            raise
+        return filename
+
+    def _grab(self, url, filename, reget=None, checksum=None, cache=True):
+        """Download url to filename, or take it from the package cache
+        if cache is set. Returns True in the latter case."""
+        prefetched = self.prefetched.pop(url, None)
+        if prefetched is not None:
+            shutil.move(prefetched, filename)
+            return False
+        started = time.time()
+        cached = False
+        verified = None
+        cache = cache and checksum and PACKAGE_CACHE is not None
+        if cache:
+            cached = PACKAGE_CACHE.get(checksum, filename)
+        if not cached:
+            verified = self._download(url, filename, reget, checksum)
+            if cache:
+                PACKAGE_CACHE.put(checksum, filename,
+                                  verified=verified == checksum)
+            if checksum and verified == checksum:
+                self._set_verified(url, filename, checksum)
+        if self.hooks:
+            self._emit('download', url=url, filename=filename, cached=cached,
+                       verified=verified is not None,
+                       bytes=os.path.getsize(filename),
+                       duration=time.time() - started)
+        return cached
+
+    def discard_prefetched(self):
+        """Remove the files prefetch_metadata() downloaded that urlgrab()
+        was not called for."""
+        while self.prefetched:
+            url, filename = self.prefetched.popitem()
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def _set_verified(self, url, filename, checksum):
+        """Let yum know that the package at url has been verified, so
+        that verifyLocalPkg() doesn't read it again."""
+        package = self.packages.get(url)
+        if package is not None and package.returnIdSum() == checksum:
+            package._verify_local_pkg_cache = os.stat(filename)
+
+    def _async_done(self, url, filename, kwargs, checksum, cached, exception):
+        from urlgrabber.grabber import CallbackObject, URLGrabError
+        obj = CallbackObject(url=url, filename=filename)
+        if exception is None:
             try:
-                response = urllib2.urlopen(request)
-                buff = response.read(BUFFER_SIZE)
-                while buff:
-                    out.write(buff)
-                    buff = response.read(BUFFER_SIZE)
-            except urllib2.HTTPError, e:
-                if retries > 0:
-                    time.sleep(delay)
-                    delay *= self.backoff
-                else:
+                run_callback(kwargs.get('checkfunc'), obj)
+                return
+            except URLGrabError, e:
+                if cached:
+                    PACKAGE_CACHE.discard(checksum)
+                exception = e
+        obj.exception = exception
+        if kwargs.get('failfunc') is None:
+            raise exception
+        run_callback(kwargs['failfunc'], obj)
+
+    def _retry(self, url, func, failover=True):
+        """Call func() until it succeeds, it fails for good or `retries`
+        attempts were made, as decided by RetryPolicy. Without failover
+        func() always makes its request to the same replica."""
+        policy = RetryPolicy(max(self.retries, 1), self.delay, self.backoff,
+                             self.max_delay)
+        attempt = 0
+        # Replicas that failed this call, which _choose_replica() avoids
+        # until it returns
+        previous = getattr(self.local, 'tried', None)
+        tried = self.local.tried = set()
+        try:
+            while True:
+                attempt += 1
+                self.local.attempt = attempt
+                try:
+                    return func()
+                except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+                    action = policy.classify(e)
+                    if action == 'refresh' and not self.credential_source:
+                        # Static credentials can't be refreshed
+                        action = 'fatal'
+                    replica = getattr(self.local, 'replica', None)
+                    if failover and len(self.replicas) > 1 and replica is not None:
+                        tried.add(replica)
+                        code = getattr(e, 'code', None)
+                        if action == 'retry' and code != 412:
+                            replica.fail()
+                        elif (action == 'fatal' and code == 404 and
+                                len(tried) < len(self.replicas)):
+                            # Maybe not replicated there yet
+                            action = 'failover'
+                    if action == 'failover' or (action != 'fatal' and
+                                                attempt < policy.attempts):
+                        if action in ('refresh', 'failover') or (
+                                failover and self._replica_left(tried)):
+                            delay = 0
+                        else:
+                            delay = policy.wait_time(attempt, e)
+                        if self.hooks:
+                            self._emit('retry', url=url, attempt=attempt,
+                                       delay=delay, reason=action, error=str(e))
+                        if action == 'refresh':
+                            self.refresh_credentials(force=True)
+                        elif delay:
+                            time.sleep(delay)
+                        continue
                     # Wrap exception as URLGrabError so that YumRepository catches it
                     from urlgrabber.grabber import URLGrabError
-                    msg = '%s on %s tried' % (e, url)
-                    if self.retries > 0:
-                        msg += ' tried %d time(s)' % (self.retries)
-                        new_e = URLGrabError(14, msg)
-                        new_e.code = e.code
-                        new_e.exception = e
-                        new_e.url = url
-                        raise new_e
+                    msg = '%s on %s tried %d time(s)' % (e, url, attempt)
+                    new_e = URLGrabError(14, msg)
+                    new_e.code = getattr(e, 'code', None)
+                    new_e.exception = e
+                    new_e.url = url
+                    raise new_e
+                except EnvironmentError, e:
+                    # Writing the file failed, e.g. the disk is full.
+                    # URLGrabError is one too and is passed on as it is.
+                    from urlgrabber.grabber import URLGrabError
+                    if isinstance(e, URLGrabError):
+                        raise
+                    new_e = URLGrabError(16, '%s writing %s' % (e, url))
+                    new_e.exception = e
+                    new_e.url = url
+                    raise new_e
+                finally:
+                    self.local.attempt = 1
+        finally:
+            self.local.tried = previous
+
+    def _replica_left(self, tried):
+        """Whether another replica that is up wasn't tried yet."""
+        if len(self.replicas) == 1:
+            return False
+        now = time.time()
+        return any(r not in tried and r.down_until <= now
+                   for r in self.replicas)
+
+    def _download(self, url, filename, reget=None, checksum=None):
+        """Download url to filename.
+
+        Data is written to filename.part, which is renamed to filename
+        once complete. The first request asks for multipart_chunksize
+        bytes; when the object turns out to be bigger, the rest is
+        fetched with further Range requests, in parallel above
+        multipart_threshold, each written at its offset.
+
+        While the file is downloaded sequentially its ETag is kept in
+        filename.etag, so that a later call with reget can resume it.
+
+        Repository metadata is revalidated with If-None-Match and
+        If-Modified-Since against the copy kept from the last download,
+        which is used again if S3 answers 304 Not Modified.
+
+        The file is checked against checksum, or the object's MD5 from
+        its ETag, as it is written; a mismatch fails the attempt. Returns
+        the checksum that was verified, if any.
+        """
+        chunksize = self.multipart_chunksize
+        multipart = self.multipart_threshold > 0 and chunksize > 0
+        partial = filename + '.part'
+        etag_file = filename + '.etag'
+        cached = self._metadata_path(url)
+        if (self.delta_metadata and cached and not os.path.exists(cached) and
+                not os.path.exists(etag_file)):
+            base = self._delta_base(cached)
+            if base is not None:
+                verified = self._download_delta(url, filename, base, checksum,
+                                                cached)
+                if verified is not None:
+                    return verified
+
+        transfer = Transfer(url, etag_file=etag_file)
+        transfer.checksum = checksum
+        transfer.restart_digest()
+        # Parts of a multipart download already written
+        done = None
+        if reget and os.path.exists(partial) and os.path.exists(etag_file):
+            state = open(etag_file).read().split()
+            if len(state) >= 3:
+                # ETag, size, part size and the byte ranges of the parts
+                # done, as written below
+                transfer.etag = state[0]
+                transfer.total = int(state[1])
+                chunksize = int(state[2])
+                done = set(tuple(int(n) for n in part.split('-'))
+                           for part in state[3:])
+            else:
+                transfer.offset = os.path.getsize(partial)
+                transfer.etag = state and state[0] or None
+        if done is None and transfer.offset and transfer.etag:
+            if transfer.digest is not None:
+                hash_file(transfer.digest, partial, transfer.offset)
+            transfer.out = open(partial, 'r+b', 0)
+        elif done is None:
+            # Whatever an earlier download left can't be resumed
+            for stale in (partial, etag_file):
+                if os.path.exists(stale):
+                    os.unlink(stale)
+            transfer.offset = 0
+            transfer.etag = None
+            transfer.out = open(partial, 'wb', 0)
+            if multipart:
+                transfer.end = chunksize - 1
+            if cached and os.path.exists(cached):
+                try:
+                    transfer.validators = json.load(open(cached + '.json'))
+                except (IOError, ValueError):
+                    pass
+
+        try:
+            if done is None:
+                try:
+                    self._retry(url, lambda: self._fetch(transfer))
+                finally:
+                    transfer.out.close()
+
+            if transfer.not_modified:
+                os.unlink(partial)
+                link_or_copy(cached, filename)
+                transfer.forget_etag()
+                return None
+
+            total = transfer.total
+            if (done is None and transfer.end is not None and
+                    total is not None and total > chunksize):
+                # Parts are written out of order, so the file can't be
+                # resumed by its size any more: the .etag file records the
+                # object's size, the part size and each part done instead.
+                done = set()
+                if transfer.etag_file and transfer.etag:
+                    f = open(transfer.etag_file, 'w')
+                    try:
+                        f.write('%s\n%d %d\n' % (transfer.etag, total, chunksize))
+                    finally:
+                        f.close()
+                else:
+                    transfer.forget_etag()
+            if done is not None:
+                self._download_parts(url, partial, transfer, chunksize, done)
+                if checksum:
+                    # Parts were written out of order, hash the whole file
+                    # once here rather than in yum and the package cache.
+                    if file_checksum(checksum[0], partial) != checksum[1]:
+                        from urlgrabber.grabber import URLGrabError
+                        raise URLGrabError(-1, 'Checksum mismatch on %s' % url)
+                    transfer.checksum = checksum
+                    transfer.verified = True
+            # Replaces filename, even a link to a cached copy, atomically
+            os.rename(partial, filename)
+        except:
+            # Only keep a partial download that can be resumed
+            if not os.path.exists(etag_file) and os.path.exists(partial):
+                os.unlink(partial)
+            raise
+        transfer.forget_etag()
+        if cached:
+            self._save_metadata(transfer, filename, cached)
+        return transfer.checksum if transfer.verified else None
+
+    def _download_parts(self, url, partial, transfer, chunksize, done):
+        """Fetch the parts of transfer after its first chunksize bytes
+        into partial, in parallel above multipart_threshold, except the
+        (start, end) byte ranges in done. Each part is added to the .etag
+        file of the transfer once written."""
+        total = transfer.total
+        if total <= self.multipart_threshold:
+            parts = [(chunksize, total - 1)]
+        else:
+            parts = [(start, min(start + chunksize, total) - 1)
+                     for start in range(chunksize, total, chunksize)]
+        lock = threading.Lock()
+
+        def fetch_part(part):
+            if part in done:
+                return
+            from urlgrabber.grabber import URLGrabError
+            out = open(partial, 'r+b', 0)
+            part = Transfer(url, out, part[0], part[1], transfer.etag)
+            try:
+                self._retry(url, lambda: self._fetch(part))
+            except URLGrabError, e:
+                if getattr(e, 'code', None) == 412:
+                    # The object changed, the parts done are of no use
+                    with lock:
+                        transfer.forget_etag()
+                raise
             finally:
-                retries -= 1
-                if response:
-                    response.close()
-                    break
+                out.close()
+            with lock:
+                if transfer.etag_file:
+                    f = open(transfer.etag_file, 'a')
+                    try:
+                        f.write('%d-%d\n' % (part.start, part.end))
+                    finally:
+                        f.close()
+        run_parallel(fetch_part, parts, self.max_connections)
+
+    def _metadata_path(self, url):
+        """Where the copy of repodata file url is kept, None for other
+        files."""
+        if (self.metadata_dir is None or
+                os.path.basename(os.path.dirname(url)) != 'repodata'):
+            return None
+        return os.path.join(self.metadata_dir, os.path.basename(url))
+
+    def _metadata_versions(self, cached):
+        """Kept copies of other versions of metadata file cached, newest
+        first."""
+        if not os.path.isdir(self.metadata_dir):
+            return []
+        name = os.path.basename(cached)
+        family = metadata_family(name)
+        paths = [os.path.join(self.metadata_dir, other)
+                 for other in os.listdir(self.metadata_dir)
+                 if other != name and not other.endswith('.json') and
+                 metadata_family(other) == family]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        return paths
+
+    def _save_metadata(self, transfer, filename, cached):
+        """Keep a copy of metadata file filename, with its validators,
+        in place of the copies of its earlier versions."""
+        if not (transfer.etag or transfer.last_modified or self.delta_metadata):
+            return
+        if not os.path.isdir(self.metadata_dir):
+            os.makedirs(self.metadata_dir)
+        link_or_copy(filename, cached)
+        for path in self._metadata_versions(cached):
+            for old in (path, path + '.json'):
+                if os.path.exists(old):
+                    os.unlink(old)
+        if not (transfer.etag or transfer.last_modified):
+            return
+        f = open(cached + '.json', 'w')
+        try:
+            json.dump({'ETag': transfer.etag,
+                       'Last-Modified': transfer.last_modified}, f)
+        finally:
+            f.close()
+
+    def _delta_base(self, cached):
+        """The kept copy of an earlier version of metadata file cached,
+        None if there is none."""
+        versions = self._metadata_versions(cached)
+        return versions[0] if versions else None
+
+    def _download_delta(self, url, filename, base, checksum, cached):
+        """Rebuild url into filename from base, an earlier version of
+        the same metadata file, and the chunks that changed since.
+
+        The chunks of the new version are listed in its chunk index
+        (url + DELTA_INDEX_SUFFIX). Those also found in base are copied
+        from it, the others fetched with Range requests. Returns the
+        checksum that was verified, or None when the file couldn't be
+        rebuilt and has to be downloaded whole.
+        """
+        started = time.time()
+        partial = filename + '.part'
+        fetched = 0
+        try:
+            index = json.loads(self.urlread(url + DELTA_INDEX_SUFFIX))
+            size = int(index['size'])
+            chunk_size = int(index['chunk_size'])
+            expected = tuple(index['checksum'])
+            if checksum and checksum[0] == expected[0] and checksum != expected:
+                raise ValueError('chunk index out of date')
+
+            local = {}
+            for i, value in enumerate(chunk_hashes(base, chunk_size)):
+                local.setdefault(value, i * chunk_size)
+            # Missing byte ranges, adjacent chunks merged up to
+            # multipart_chunksize
+            ranges = []
+            merge_size = self.multipart_chunksize or size
+            out = open(partial, 'wb', 0)
+            try:
+                preallocate(out, size)
+                src = open(base, 'rb')
+                try:
+                    for i, value in enumerate(index['chunks']):
+                        start = i * chunk_size
+                        end = min(start + chunk_size, size) - 1
+                        if value in local:
+                            src.seek(local[value])
+                            out.seek(start)
+                            out.write(src.read(end - start + 1))
+                        elif (ranges and ranges[-1][1] == start - 1 and
+                                end - ranges[-1][0] < merge_size):
+                            ranges[-1] = (ranges[-1][0], end)
+                        else:
+                            ranges.append((start, end))
+                finally:
+                    src.close()
+                out.truncate(size)
+            finally:
+                out.close()
+
+            summary = Transfer(url)
+
+            def fetch_range(item):
+                out = open(partial, 'r+b', 0)
+                part = Transfer(url, out, item[0], item[1], summary.etag)
+                try:
+                    self._retry(url, lambda: self._fetch(part))
+                finally:
+                    out.close()
+                if part.total != size:
+                    raise ValueError('chunk index out of date')
+                return part
+            if ranges:
+                # The first response tells the ETag the others must match
+                first = fetch_range(ranges[0])
+                summary.etag = first.etag
+                summary.last_modified = first.last_modified
+                run_parallel(fetch_range, ranges[1:], self.max_connections)
+                fetched = sum(end - start + 1 for start, end in ranges)
+
+            if file_checksum(expected[0], partial) != expected[1]:
+                raise ValueError('checksum mismatch')
+            verified = expected
+            if checksum and checksum[0] != expected[0]:
+                if file_checksum(checksum[0], partial) != checksum[1]:
+                    raise ValueError('checksum mismatch')
+                verified = checksum
+            os.rename(partial, filename)
+        except Exception, e:
+            if os.path.exists(partial):
+                os.unlink(partial)
+            if self.hooks:
+                self._emit('delta', url=url, error=str(e),
+                           duration=time.time() - started)
+            return None
+        if self.hooks:
+            self._emit('delta', url=url, bytes=fetched, reused=size - fetched,
+                       ranges=len(ranges), duration=time.time() - started)
+        self._save_metadata(summary, filename, cached)
+        return verified
+
+    def _fetch(self, transfer):
+        """Make one attempt at transfer, from where the previous one
+        stopped. Data is written to transfer.out at its offset."""
+        headers = {}
+        if transfer.offset or transfer.end is not None:
+            end = '' if transfer.end is None else transfer.end
+            headers['Range'] = 'bytes=%d-%s' % (transfer.offset, end)
+        if transfer.etag:
+            headers['If-Match'] = transfer.etag
+        elif transfer.validators:
+            if transfer.validators.get('ETag'):
+                headers['If-None-Match'] = transfer.validators['ETag']
+            if transfer.validators.get('Last-Modified'):
+                headers['If-Modified-Since'] = transfer.validators['Last-Modified']
+        request = self._request(transfer.url, headers=headers)
+        try:
+            response = self._open(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and transfer.validators:
+                transfer.not_modified = True
+                return
+            if e.code == 416 and transfer.etag and transfer.end is None:
+                # Resumed file was already complete
+                transfer.total = transfer.offset
+                self._check_digest(transfer)
+                return
+            if (e.code == 416 and transfer.start == 0 and
+                    transfer.offset == 0 and transfer.end is not None):
+                # The first range of an empty object can't be satisfied
+                transfer.end = None
+                if e.info().getheader('Content-Range') == 'bytes */0':
+                    transfer.total = 0
+                    self._check_digest(transfer)
+                    return
+                # No size given, ask for the whole object instead
+                return self._fetch(transfer)
+            if e.code == 412 and transfer.start == 0:
+                # Object changed since the last attempt, start over
+                transfer.restart()
+            raise
 
-        out.close()
-        return filename
+        try:
+            if getattr(response, 'code', None) == 206:
+                info = response.info()
+                m = re.match(r'bytes (\d+)-\d+/(\d+)$',
+                             info.getheader('Content-Range') or '')
+                if not m or int(m.group(1)) != transfer.offset:
+                    raise httplib.HTTPException('Unexpected Content-Range')
+                transfer.total = size = int(m.group(2))
+                transfer.set_etag(info.getheader('ETag'))
+                transfer.last_modified = info.getheader('Last-Modified')
+            else:
+                if transfer.start:
+                    raise httplib.HTTPException('Range request not honoured')
+                # Whole object
+                transfer.restart()
+                transfer.total = size = None
+                if hasattr(response, 'info'):
+                    info = response.info()
+                    transfer.set_etag(info.getheader('ETag'))
+                    transfer.last_modified = info.getheader('Last-Modified')
+                    if (info.getheader('Content-Length') or '').isdigit():
+                        size = int(info.getheader('Content-Length'))
+            if transfer.start == 0 and size:
+                preallocate(transfer.out, size)
+            if (transfer.checksum is None and transfer.start == 0 and
+                    transfer.offset == 0 and hasattr(response, 'info')):
+                transfer.checksum = etag_checksum(response.info())
+                transfer.restart_digest()
+            transfer.out.seek(transfer.offset)
+            offset = transfer.offset
+            started = time.time()
+            digest = transfer.digest
+            limiter = self.rate_limiter
+            size = self.buffer_size
+            if limiter is not None:
+                size = min(size, limiter.chunk)
+            buff = self._buffer(size)
+            readinto = getattr(response, 'readinto', None)
+            while True:
+                if readinto is not None:
+                    # buffer() rather than memoryview, which Python 2.6
+                    # lacks; neither copies the data
+                    chunk = buffer(buff, 0, readinto(buff))
+                else:
+                    chunk = response.read(len(buff))
+                if not len(chunk):
+                    break
+                if limiter is not None:
+                    limiter.consume(len(chunk))
+                transfer.out.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                transfer.offset += len(chunk)
+            received = transfer.offset - offset
+            elapsed = time.time() - started
+            # A throttled transfer measures the throttle, not the replica
+            if limiter is None and received >= REPLICA_MIN_SAMPLE and elapsed > 0:
+                request.replica.observe(throughput=received / elapsed)
+        finally:
+            response.close()
+        if transfer.total is None or transfer.offset >= transfer.total:
+            self._check_digest(transfer)
+
+    def _buffer(self, size):
+        """The current thread's transfer buffer of size bytes, reused
+        between reads."""
+        buff = getattr(self.local, 'buffer', None)
+        if buff is None or len(buff) != size:
+            buff = self.local.buffer = bytearray(size)
+        return buff
+
+    def _check_digest(self, transfer):
+        """Compare a complete transfer with its checksum; when they
+        differ, start it over and fail the attempt."""
+        if transfer.digest is None:
+            return
+        if transfer.digest.hexdigest() != transfer.checksum[1]:
+            transfer.restart()
+            raise httplib.HTTPException('Checksum mismatch')
+        transfer.verified = True
+
+    def _presigned_kwargs(self, kwargs):
+        """kwargs of a call to the presigned grabber, with the current
+        presigned_options, which kwargs take precedence over."""
+        if self.presigned_options is None:
+            return kwargs
+        options = self.presigned_options()
+        options.update(kwargs)
+        return options
 
     def urlopen(self, url, **kwargs):
         """urlopen(url) open the remote file and return a file object."""
-        return urllib2.urlopen(self._request(url))
+        if self.presigned is not None:
+            return self.presigned.urlopen(self.presign(url),
+                                          **self._presigned_kwargs(kwargs))
+        return self._retry(url, lambda: self._open(self._request(url)))
+
+    def list_objects(self):
+        """(path, size, ETag) of every object under the baseurl, path
+        relative to it, as listed by ListObjectsV2.
+
+        All pages are listed from one replica, whose continuation tokens
+        other replicas wouldn't take."""
+        from xml.etree import cElementTree as ElementTree
+        ns = '{http://s3.amazonaws.com/doc/2006-03-01/}'
+        objects = []
+        token = None
+        replica = self._choose_replica()
+        while True:
+            def read():
+                request = self._list_request(replica, token)
+                response = self._open(request)
+                try:
+                    return request.prefix, response.read()
+                finally:
+                    response.close()
+            prefix, body = self._retry('?list-type=2', read, failover=False)
+            result = ElementTree.fromstring(body)
+            for contents in result.findall(ns + 'Contents'):
+                key = urllib2.unquote(
+                    contents.findtext(ns + 'Key').replace('+', ' '))
+                path = key[len(prefix):]
+                if key.startswith(prefix) and path and not path.endswith('/'):
+                    objects.append((path, int(contents.findtext(ns + 'Size')),
+                                    contents.findtext(ns + 'ETag')))
+            token = result.findtext(ns + 'NextContinuationToken')
+            if result.findtext(ns + 'IsTruncated') != 'true' or not token:
+                return objects
 
     def urlread(self, url, limit=None, **kwargs):
         """urlread(url) return the contents of the file as a string."""
-        return urllib2.urlopen(self._request(url)).read()
+        if self.presigned is not None:
+            return self.presigned.urlread(self.presign(url), limit,
+                                          **self._presigned_kwargs(kwargs))
+
+        def read():
+            response = self._open(self._request(url))
+            try:
+                return response.read()
+            finally:
+                response.close()
+        return self._retry(url, read)
 
-    def signV2(self, request, timeval=None):
+    def signV2(self, request, timeval=None, endpoint=None):
         """Attach a valid S3 signature to request.
         request - instance of Request
+        endpoint - Endpoint the request is sent to, by default self.endpoint
         """
         t = timeval or time.gmtime()
         date = time.strftime("%a, %d %b %Y %H:%M:%S +0000", t)
         request.add_header('Date', date)
 
-        (bucket, ignore, path) = parse_url(request.get_full_url())
-        resource = '/' + bucket + path
-        if self.token:
-            amz_headers = 'x-amz-security-token:%s\n' % self.token
-            request.add_header('x-amz-security-token', self.token)
+        endpoint = endpoint or self.endpoint
+        # None of the query parameters used are sub-resources, which
+        # would be part of the resource signed
+        if endpoint is not None and request.get_host() == endpoint.host:
+            resource = request.get_selector().split('?', 1)[0]
+            if endpoint.style == 'virtual':
+                resource = '/' + endpoint.bucket + resource
+        else:
+            (bucket, ignore, path) = parse_url(request.get_full_url())
+            resource = '/' + bucket + path.split('?', 1)[0]
+        # Read once, a refresh in another thread replaces them as a whole
+        credentials = self.credentials
+        if credentials.token:
+            amz_headers = 'x-amz-security-token:%s\n' % credentials.token
+            request.add_header('x-amz-security-token', credentials.token)
         else:
             amz_headers = ''
         sigstring = ("%(method)s\n\n\n%(date)s\n"
@@ -404,12 +2642,12 @@ class S3Grabber(object):
                          'canon_amzn_headers': amz_headers,
                          'canon_amzn_resource': resource})
         digest = hmac.new(
-            str(self.secret_key),
+            str(credentials.secret_key),
             str(sigstring),
             hashlib.sha1).digest()
         signature = digest.encode('base64').rstrip()
 
-        authorization = "AWS {0}:{1}".format(self.access_key, signature)
+        authorization = "AWS {0}:{1}".format(credentials.access_key, signature)
         request.add_header('Authorization', authorization)
 
     def derive(self, key, msg):
@@ -421,43 +2659,737 @@ class S3Grabber(object):
         kService = self.derive(kRegion, service)
         return self.derive(kService, 'aws4_request')
 
-    def signV4(self, request, timeval=None):
+    def signing_key(self, datestamp, region, service='s3', credentials=None):
+        """Return the SigV4 signing key and credential scope.
+
+        Deriving the key takes four HMACs and only changes with the
+        credentials and the date, so it is cached process-wide. An entry
+        is only used if it was derived from the current secret key, and
+        entries for other dates are dropped when a new one is added.
+        credentials - Credentials to derive the key from, by default
+                      self.credentials
+        """
+        access_key, secret_key, token = credentials or self.credentials
+        cache_key = (access_key, datestamp, region, service)
+        cached = SIGNING_KEYS.get(cache_key)
+        if cached is not None and cached[0] == secret_key:
+            return cached[1], cached[2]
+
+        key = self.deriveKey(secret_key, datestamp, region, service)
+        scope = '%s/%s/%s/aws4_request' % (datestamp, region, service)
+        for k in SIGNING_KEYS.keys():
+            if k[1] != datestamp:
+                SIGNING_KEYS.pop(k, None)
+        SIGNING_KEYS[cache_key] = (secret_key, key, scope)
+        return key, scope
+
+    def _signature_v4(self, canonical_request, amzdate, region,
+                      credentials=None):
+        """SigV4 signature of canonical_request made at amzdate with
+        credentials (self.credentials by default), and its credential
+        scope."""
+        req_hash = hashlib.sha256(canonical_request).hexdigest()
+
+        # Get derived key
+        signing_key, scope = self.signing_key(amzdate[:8], region,
+                                              credentials=credentials)
+
+        # Assemble content to be signed
+        sign_content = '%s\n%s\n%s\n%s' % ('AWS4-HMAC-SHA256', amzdate,
+                                            scope, req_hash)
+
+        # Compute signature
+        signature = hmac.new(signing_key, (sign_content).encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        return signature, scope
+
+    def presign(self, path, expires=None, timeval=None):
+        """URL of path with a SigV4 signature in its query string, which
+        any HTTP client can fetch for `expires` seconds (presign_expires
+        by default), or until the credentials expire if sooner."""
+        if self.refresh_at is not None and time.time() >= self.refresh_at:
+            self.refresh_credentials()
+        credentials = self.credentials
+        replica = self._choose_replica()
+        url = urlparse.urljoin(replica.baseurl, urllib2.quote(path))
+        expires = expires or self.presign_expires
+        if self.expiration:
+            remaining = parse_expiration(self.expiration) - time.time()
+            expires = max(1, min(expires, int(remaining)))
+        if timeval:
+            t = datetime.datetime(*timeval[:6])
+        else:
+            t = datetime.datetime.utcnow()
+        amzdate = t.strftime('%Y%m%dT%H%M%SZ')
+        # The global endpoint and custom ones take us-east-1
+        region = replica.region or 'us-east-1'
+        scope = '%s/%s/s3/aws4_request' % (amzdate[:8], region)
+
+        params = [('X-Amz-Algorithm', 'AWS4-HMAC-SHA256'),
+                  ('X-Amz-Credential', '%s/%s' % (credentials.access_key, scope)),
+                  ('X-Amz-Date', amzdate),
+                  ('X-Amz-Expires', str(expires)),
+                  ('X-Amz-SignedHeaders', 'host')]
+        if credentials.token:
+            params.append(('X-Amz-Security-Token', credentials.token))
+        query = canonical_query(params)
+        parts = urlparse.urlsplit(url)
+        req = 'GET\n%s\n%s\nhost:%s\n\nhost\nUNSIGNED-PAYLOAD' % (
+            parts.path, query, parts.netloc)
+        signature, scope = self._signature_v4(req, amzdate, region,
+                                              credentials)
+        return '%s?%s&X-Amz-Signature=%s' % (url, query, signature)
+
+    def signV4(self, request, timeval=None, region=None):
         algorithm = 'AWS4-HMAC-SHA256'
-        t = datetime.datetime.utcnow()
+        if timeval:
+            t = datetime.datetime(*timeval[:6])
+        else:
+            t = datetime.datetime.utcnow()
 
         amzdate = t.strftime('%Y%m%dT%H%M%SZ')
         amz_headers = ('host:%s\nx-amz-date:%s\n' %
                        (request.get_host(), amzdate))
         signed_headers = 'host;x-amz-date'
-        if self.token:
-            amz_headers += 'x-amz-security-token:%s\n' % self.token
+        credentials = self.credentials
+        if credentials.token:
+            amz_headers += 'x-amz-security-token:%s\n' % credentials.token
             signed_headers += ';x-amz-security-token'
-            request.add_header('x-amz-security-token', self.token)
+            request.add_header('x-amz-security-token', credentials.token)
 
         # Hash request
-        content_h = hashlib.sha256('').hexdigest()  # Empty content
-        req = ('GET\n%s\n\n%s\n%s\n%s' %
-               (request.get_selector(), amz_headers, signed_headers, content_h))
-        req_hash = hashlib.sha256(req).hexdigest()
-
-        # Assemble content to be signed
-        datestamp = t.strftime('%Y%m%d')
-        scope = datestamp + '/' + self.region + '/s3/aws4_request'
-        sign_content = '%s\n%s\n%s\n%s' % (algorithm, amzdate, scope, req_hash)
-
-        # Get derived key
-        signing_key = self.deriveKey(self.secret_key, datestamp,
-                                     self.region, 's3')
-
-        # Compute signature
-        signature = hmac.new(signing_key, (sign_content).encode('utf-8'),
-                             hashlib.sha256).hexdigest()
+        content_h = EMPTY_PAYLOAD_HASH  # Empty content
+        path, sep, query = request.get_selector().partition('?')
+        if query:
+            query = canonical_query(urlparse.parse_qsl(query, True))
+        req = ('GET\n%s\n%s\n%s\n%s\n%s' %
+               (path, query, amz_headers, signed_headers, content_h))
+        signature, scope = self._signature_v4(req, amzdate,
+                                              region or self.region,
+                                              credentials)
 
         # Assemble 'Authorization' header value
-        credential = self.access_key + '/' + scope
+        credential = credentials.access_key + '/' + scope
         auth = (('%s Credential=%s, SignedHeaders=%s, Signature=%s') %
                 (algorithm, credential, signed_headers, signature))
 
         request.add_header('x-amz-content-sha256', content_h)
         request.add_header('x-amz-date', amzdate)
         request.add_header('Authorization', auth)
+
+
+class StandaloneRepository(object):
+    """Options of a repository used outside of yum, by the proxy and
+    mirror commands, read by S3Grabber in place of those of a yum
+    repository."""
+
+    def __init__(self, name, endpoints):
+        self.id = name
+        self.baseurl = [endpoint.url for endpoint in endpoints]
+        self.region = endpoints[0].region
+        self.retries = DEFAULT_STANDALONE_RETRIES
+        self.backoff = None
+        self.delay = None
+        # http_proxy and https_proxy, as yum repositories honour them
+        self.proxy_config = urllib2.getproxies()
+
+
+class S3Proxy(object):
+    """Repositories served to yum on other hosts or containers, or to
+    other processes, over plain HTTP by proxy_server().
+
+    A path /<name>/<file> is file of the repository added as name. All
+    requests to S3 are signed with the one set of credentials of the
+    proxy, so N clients cost one credential lookup, and files are kept
+    under cachedir, least recently used ones removed past max_size
+    bytes. Packages are served from there without asking S3 again;
+    repodata files are revalidated with S3 once older than
+    metadata_expire seconds. Concurrent requests for a file that isn't
+    in the cache wait for a single download.
+    """
+
+    def __init__(self, cachedir, max_size=DEFAULT_PROXY_CACHE_SIZE,
+                 metadata_expire=DEFAULT_PROXY_METADATA_EXPIRE,
+                 credential_source='instance_role'):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.metadata_expire = metadata_expire
+        self.credential_source = credential_source
+        self.access_key = None
+        self.secret_key = None
+        self.grabbers = {}
+        self.lock = threading.Lock()
+        # Downloads in progress, by (name, path)
+        self.inflight = {}
+        # When repodata files were last checked with S3, by (name, path)
+        self.validated = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def set_credentials(self, access_key, secret_key):
+        self.access_key = access_key
+        self.secret_key = secret_key
+
+    def log(self, message):
+        """Log a request served by proxy_server()."""
+        import sys
+        sys.stderr.write(message + '\n')
+
+    def add_repository(self, name, baseurls):
+        """Serve the repository at baseurls as name, return its grabber."""
+        if not re.match(r'^[A-Za-z0-9_.:-]+$', name):
+            raise yum.plugins.PluginYumExit(
+                "s3iam: invalid repository name '%s'" % name)
+        grabber = S3Grabber(StandaloneRepository(name, parse_baseurls(name, baseurls)))
+        grabber.metadata_dir = os.path.join(self.cachedir, 'metadata', name)
+        if self.access_key and self.secret_key:
+            grabber.set_credentials(self.access_key, self.secret_key)
+        else:
+            grabber.credential_source = self.credential_source
+        self.grabbers[name] = grabber
+        return grabber
+
+    def _split(self, path):
+        """(name, file) of request path, None for a path outside of the
+        repositories."""
+        path = urllib2.unquote(path.split('?', 1)[0].split('#', 1)[0])
+        parts = path.lstrip('/').split('/', 1)
+        if len(parts) != 2 or parts[0] not in self.grabbers:
+            return None
+        name, path = parts
+        if not path or path.endswith('/'):
+            return None
+        if any(part in ('', '.', '..') for part in path.split('/')):
+            return None
+        return name, path
+
+    def _fresh(self, key, filename):
+        if not os.path.exists(filename):
+            return False
+        if self.grabbers[key[0]]._metadata_path(key[1]) is None:
+            return True
+        return time.time() - self.validated.get(key, 0) < self.metadata_expire
+
+    def open(self, path):
+        """Open the cached copy of request path, downloading it first
+        if needed. Returns None when the path isn't served; S3 errors
+        are raised as URLGrabError."""
+        key = self._split(path)
+        if key is None:
+            return None
+        filename = os.path.join(self.cachedir, 'files', *key)
+        while True:
+            with self.lock:
+                fresh = self._fresh(key, filename)
+                flight = self.inflight.get(key)
+                leader = not fresh and flight is None
+                if fresh:
+                    self.hits += 1
+                elif leader:
+                    flight = self.inflight[key] = {
+                        'done': threading.Event(), 'error': None}
+                    self.misses += 1
+                else:
+                    self.coalesced += 1
+            if leader:
+                self._download(key, filename, flight)
+            elif not fresh:
+                flight['done'].wait()
+                if flight['error'] is not None:
+                    raise flight['error']
+            try:
+                f = open(filename, 'rb')
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Evicted meanwhile
+                continue
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+            if leader:
+                evict_files(os.path.join(self.cachedir, 'files'),
+                            self.max_size, skip=('.part', '.etag'))
+            return f
+
+    def _download(self, key, filename, flight):
+        grabber = self.grabbers[key[0]]
+        try:
+            if grabber.access_key is None and grabber.credential_source:
+                grabber.refresh_credentials()
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            started = time.time()
+            grabber.urlgrab(key[1], filename, reget='simple')
+            self.validated[key] = started
+        except Exception, e:
+            flight['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight['done'].set()
+
+
+def proxy_server(proxy, address):
+    """HTTP server of S3Proxy proxy, listening on address. Answers GET
+    and HEAD requests, with a Range of bytes=N- or bytes=N-M."""
+    import BaseHTTPServer
+    import SocketServer
+    from urlgrabber.grabber import URLGrabError
+
+    class ProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+        server_version = 's3iam/' + __version__
+
+        def log_message(self, format, *args):
+            proxy.log('%s - - [%s] %s' % (self.client_address[0],
+                                          self.log_date_time_string(),
+                                          format % args))
+
+        def do_HEAD(self):
+            self._serve(False)
+
+        def do_GET(self):
+            self._serve(True)
+
+        def _serve(self, body):
+            try:
+                f = proxy.open(self.path)
+            except URLGrabError, e:
+                code = 404 if getattr(e, 'code', None) == 404 else 502
+                self.send_error(code, str(e))
+                return
+            except (IOError, OSError), e:
+                self.send_error(500, str(e))
+                return
+            if f is None:
+                self.send_error(404)
+                return
+            try:
+                size = os.fstat(f.fileno()).st_size
+                start, end = 0, size - 1
+                m = re.match(r'^bytes=(\d+)-(\d*)$',
+                             self.headers.getheader('Range') or '')
+                if m:
+                    start = int(m.group(1))
+                    if m.group(2):
+                        end = min(end, int(m.group(2)))
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */%d' % size)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range',
+                                     'bytes %d-%d/%d' % (start, end, size))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end + 1 - start))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                if not body:
+                    return
+                f.seek(start)
+                left = end + 1 - start
+                while left > 0:
+                    data = f.read(min(left, BUFFER_SIZE))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    left -= len(data)
+            finally:
+                f.close()
+
+    class ProxyHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+        request_queue_size = 128
+
+    return ProxyHTTPServer(address, ProxyRequestHandler)
+
+
+def parse_repomd(data):
+    """(type, path, size, checksum) of each metadata file listed in
+    repomd.xml data; size is None when not given."""
+    from xml.etree import cElementTree as ElementTree
+    ns = '{http://linux.duke.edu/metadata/repo}'
+    files = []
+    for element in ElementTree.fromstring(data).findall(ns + 'data'):
+        checksum = element.find(ns + 'checksum')
+        size = element.findtext(ns + 'size')
+        files.append((element.get('type'),
+                      element.find(ns + 'location').get('href'),
+                      int(size) if size else None,
+                      (checksum.get('type'), checksum.text.strip())))
+    return files
+
+
+def open_metadata(filename):
+    """Open repository metadata file filename, decompressed."""
+    if filename.endswith('.gz'):
+        import gzip
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        import bz2
+        return bz2.BZ2File(filename, 'rb')
+    if filename.endswith('.xz'):
+        import lzma
+        return lzma.LZMAFile(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def parse_primary(filename):
+    """(path, size, checksum) of each package listed in primary
+    metadata file filename."""
+    from xml.etree import cElementTree as ElementTree
+    ns = '{http://linux.duke.edu/metadata/common}'
+    packages = []
+    f = open_metadata(filename)
+    try:
+        for event, element in ElementTree.iterparse(f):
+            if element.tag != ns + 'package':
+                continue
+            checksum = element.find(ns + 'checksum')
+            packages.append((element.find(ns + 'location').get('href'),
+                             int(element.find(ns + 'size').get('package')),
+                             (checksum.get('type'), checksum.text.strip())))
+            element.clear()
+    finally:
+        f.close()
+    return packages
+
+
+class S3Mirror(object):
+    """Copy of a repository in S3, the one grabber downloads from, kept
+    in directory.
+
+    Files are compared with the objects by size and ETag, or by the
+    checksum the repository metadata gives, and only those that differ
+    are downloaded, `jobs` at a time. What was compared is recorded in
+    MIRROR_STATE_FILE, so that files unchanged since aren't read again
+    by the next run. repodata/repomd.xml is updated last, so that the
+    copy is a consistent repository at any time.
+    """
+
+    def __init__(self, grabber, directory, jobs=DEFAULT_MIRROR_JOBS):
+        self.grabber = grabber
+        self.directory = directory
+        self.jobs = jobs
+        self.state_file = os.path.join(directory, MIRROR_STATE_FILE)
+        self.state = {}
+        self.lock = threading.Lock()
+        self.downloaded = 0
+        self.bytes = 0
+        self.deleted = 0
+
+    def _filename(self, path):
+        """Local file of path, None if path would be outside of the
+        mirror."""
+        if path.startswith('/') or '..' in path.split('/'):
+            return None
+        return os.path.join(self.directory, *path.split('/'))
+
+    def _load_state(self):
+        try:
+            self.state = json.load(open(self.state_file))
+        except (IOError, ValueError):
+            self.state = {}
+
+    def _save_state(self):
+        tmp = self.state_file + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(self.state, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.state_file)
+
+    def _record(self, path, etag, checksum):
+        st = os.stat(self._filename(path))
+        with self.lock:
+            self.state[path] = {'size': st.st_size, 'mtime': st.st_mtime,
+                                'ETag': etag,
+                                'checksum': checksum and list(checksum)}
+
+    def _unchanged(self, path, size, etag, checksum):
+        """Whether the local file of path is the object of size, etag
+        or checksum."""
+        filename = self._filename(path)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if size is not None and st.st_size != size:
+            return False
+        entry = self.state.get(path)
+        if entry is not None and entry['mtime'] == st.st_mtime:
+            if etag and entry['ETag'] == etag:
+                return True
+            if checksum and entry['checksum'] == list(checksum):
+                return True
+        if checksum:
+            same = file_checksum(checksum[0], filename) == checksum[1]
+        elif etag and '-' not in etag:
+            # Not a multipart upload, the ETag is the object's MD5
+            same = file_checksum('md5', filename) == etag.strip('"')
+        else:
+            return False
+        if same:
+            self._record(path, etag, checksum)
+        return same
+
+    def _sync_file(self, item):
+        path, (size, etag, checksum) = item
+        if self._unchanged(path, size, etag, checksum):
+            return
+        filename = self._filename(path)
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        kwargs = {'checksum': tuple(checksum)} if checksum else {}
+        self.grabber.urlgrab(path, filename, reget='simple', **kwargs)
+        self._record(path, etag, checksum)
+        with self.lock:
+            self.downloaded += 1
+            self.bytes += os.path.getsize(filename)
+
+    def _sync(self, files):
+        """Bring the local copies of files, {path: (size, ETag,
+        checksum)}, up to date."""
+        items = [(path, info) for path, info in sorted(files.items())
+                 if self._filename(path) is not None]
+        try:
+            run_parallel(self._sync_file, items, self.jobs)
+        finally:
+            self._save_state()
+
+    def _delete(self, keep):
+        """Remove the local files whose path isn't in keep, and the
+        directories left empty."""
+        for root, dirs, files in os.walk(self.directory, topdown=False):
+            for name in files:
+                filename = os.path.join(root, name)
+                path = os.path.relpath(filename, self.directory)
+                path = path.replace(os.sep, '/')
+                if path == MIRROR_STATE_FILE or path in keep:
+                    continue
+                os.unlink(filename)
+                self.state.pop(path, None)
+                self.deleted += 1
+            if root != self.directory and not os.listdir(root):
+                os.rmdir(root)
+        self._save_state()
+
+    def sync_objects(self, delete=False):
+        """Copy every object under the baseurl, as listed by
+        ListObjectsV2."""
+        self._load_state()
+        files = dict((path, (size, etag, None)) for path, size, etag
+                     in self.grabber.list_objects())
+        repomd = files.pop(MIRROR_LAST, None)
+        self._sync(files)
+        if repomd is not None:
+            files[MIRROR_LAST] = repomd
+            self._sync({MIRROR_LAST: repomd})
+        if delete:
+            self._delete(files)
+
+    def sync_repository(self, delete=False):
+        """Copy the files of the repository at the baseurl, as listed
+        by repomd.xml and its primary metadata."""
+        self._load_state()
+        repomd = self.grabber.urlread(MIRROR_LAST)
+        files = {}
+        primary = []
+        for data_type, path, size, checksum in parse_repomd(repomd):
+            files[path] = (size, None, checksum)
+            if data_type == 'primary':
+                primary.append(path)
+        self._sync(files)
+        packages = {}
+        for path in primary:
+            for package, size, checksum in parse_primary(self._filename(path)):
+                packages[package] = (size, None, checksum)
+        self._sync(packages)
+        files.update(packages)
+        filename = self._filename(MIRROR_LAST)
+        if not (os.path.exists(filename) and open(filename, 'rb').read() == repomd):
+            tmp = filename + '.tmp'
+            f = open(tmp, 'wb')
+            try:
+                f.write(repomd)
+            finally:
+                f.close()
+            os.rename(tmp, filename)
+            with self.lock:
+                self.downloaded += 1
+                self.bytes += len(repomd)
+        files[MIRROR_LAST] = None
+        if delete:
+            self._delete(files)
+
+
+def add_credential_options(parser):
+    parser.add_option('--delegated-role', default=None,
+                      help='ARN of the role to assume')
+    parser.add_option('--key-id', default=None,
+                      help='access key, instead of the instance role')
+    parser.add_option('--secret-key', default=None,
+                      help='secret key, instead of the instance role')
+
+
+def credential_source(options):
+    """Credential source of the options of add_credential_options()."""
+    if options.delegated_role:
+        return 'delegated_role:%s' % options.delegated_role
+    return 'instance_role'
+
+
+def chunk_index_command(args):
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog chunk-index [--chunk-size BYTES] FILE...',
+        description='Write FILE' + DELTA_INDEX_SUFFIX + ', the chunk index '
+        'of repository metadata FILE, to be published beside it for '
+        'repositories with delta_metadata.')
+    parser.add_option('--chunk-size', type='int',
+                      default=DEFAULT_DELTA_CHUNK_SIZE,
+                      help='size of the chunks (default %default)')
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('at least one FILE expected')
+    if options.chunk_size <= 0:
+        parser.error('--chunk-size must be positive')
+    for filename in args:
+        write_chunk_index(filename, options.chunk_size)
+
+
+def proxy_command(args):
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog proxy [options] NAME=BASEURL[,BASEURL...]...',
+        description='Serve each S3 repository at BASEURL(s) as '
+        'http://ADDRESS:PORT/NAME/, signing requests with the credentials '
+        'of the instance role, a delegated role or the keys given, and '
+        'caching the files.')
+    parser.add_option('--address', default=DEFAULT_PROXY_ADDRESS,
+                      help='address to listen on (default %default)')
+    parser.add_option('--port', type='int', default=DEFAULT_PROXY_PORT,
+                      help='port to listen on (default %default)')
+    parser.add_option('--cachedir', default='/var/cache/s3iam-proxy',
+                      help='cache directory (default %default)')
+    parser.add_option('--cache-size', type='int',
+                      default=DEFAULT_PROXY_CACHE_SIZE,
+                      help='cache size, in bytes (default %default)')
+    parser.add_option('--metadata-expire', type='int',
+                      default=DEFAULT_PROXY_METADATA_EXPIRE,
+                      help='seconds before repodata files are checked '
+                           'with S3 again (default %default)')
+    add_credential_options(parser)
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('at least one NAME=BASEURL expected')
+    proxy = S3Proxy(options.cachedir, options.cache_size,
+                    options.metadata_expire, credential_source(options))
+    if options.key_id and options.secret_key:
+        proxy.set_credentials(options.key_id, options.secret_key)
+    for arg in args:
+        name, sep, baseurls = arg.partition('=')
+        if not sep:
+            parser.error('NAME=BASEURL expected, not %s' % arg)
+        try:
+            proxy.add_repository(name, baseurls.split(','))
+        except yum.plugins.PluginYumExit, e:
+            parser.error(str(e))
+    server = proxy_server(proxy, (options.address, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def mirror_command(args):
+    import optparse
+    parser = optparse.OptionParser(
+        usage='%prog mirror [options] BASEURL[,BASEURL...] DIRECTORY',
+        description='Copy the objects under S3 BASEURL (or one of its '
+        'replicas) to DIRECTORY, downloading only those that changed since '
+        'the last run.')
+    parser.add_option('--metadata', action='store_true', default=False,
+                      help='copy the files listed by the repository '
+                           'metadata, instead of all the objects listed by '
+                           'ListObjectsV2 (which needs s3:ListBucket)')
+    parser.add_option('--delete', action='store_true', default=False,
+                      help='delete the other files of DIRECTORY')
+    parser.add_option('--jobs', type='int', default=DEFAULT_MIRROR_JOBS,
+                      help='parallel downloads (default %default)')
+    add_credential_options(parser)
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('BASEURL and DIRECTORY expected')
+    if options.jobs <= 0:
+        parser.error('--jobs must be positive')
+    try:
+        repo = StandaloneRepository('mirror',
+                                    parse_baseurls('mirror', args[0].split(',')))
+    except yum.plugins.PluginYumExit, e:
+        parser.error(str(e))
+    repo.pool_size = options.jobs
+    grabber = S3Grabber(repo)
+    if options.key_id and options.secret_key:
+        grabber.set_credentials(options.key_id, options.secret_key)
+    else:
+        grabber.credential_source = credential_source(options)
+        grabber.refresh_credentials()
+    mirror = S3Mirror(grabber, args[1], options.jobs)
+    if not os.path.isdir(args[1]):
+        os.makedirs(args[1])
+    from urlgrabber.grabber import URLGrabError
+    try:
+        if options.metadata:
+            mirror.sync_repository(options.delete)
+        else:
+            mirror.sync_objects(options.delete)
+    except URLGrabError, e:
+        import sys
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+    finally:
+        if grabber.pool is not None:
+            grabber.pool.close()
+    print '%d files downloaded (%d bytes), %d deleted' % (
+        mirror.downloaded, mirror.bytes, mirror.deleted)
+
+
+COMMANDS = {
+    'chunk-index': chunk_index_command,
+    'mirror': mirror_command,
+    'proxy': proxy_command,
+}
+
+
+def main(args=None):
+    """Command line tools: chunk-index for publishers of repositories,
+    proxy to serve repositories to other hosts, mirror to copy them."""
+    import sys
+    if args is None:
+        args = sys.argv[1:]
+    if not args or args[0] not in COMMANDS:
+        sys.stderr.write('Usage: %s {%s} [options] ...\n' % (
+            os.path.basename(sys.argv[0]), ','.join(sorted(COMMANDS))))
+        sys.exit(2)
+    COMMANDS[args[0]](args[1:])
+
+
+if __name__ == '__main__':
+    main()